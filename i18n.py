@@ -297,6 +297,7 @@ _STRINGS = {
         'gap_adjusted': 'Adjusted valuation: **{val:,.2f} {cur}**',
         'gap_status_label': 'Gap Analysis',
         'gap_no_price': 'Cannot get current stock price \u2014 skipping gap analysis.',
+        'gap_small_skip': 'DCF value differs from the market price by {gap:+.1f}%, below the {min:g}% threshold \u2014 AI gap analysis skipped.',
 
         # ── Error / warning messages ──
         'err_no_fmp_key': (
@@ -650,6 +651,7 @@ _STRINGS = {
         'gap_adjusted': '\u8c03\u6574\u540e\u4f30\u503c\uff1a**{val:,.2f} {cur}**',
         'gap_status_label': '\u5dee\u5f02\u5206\u6790',
         'gap_no_price': '\u65e0\u6cd5\u83b7\u53d6\u5f53\u524d\u80a1\u4ef7\u2014\u2014\u8df3\u8fc7\u5dee\u5f02\u5206\u6790\u3002',
+        'gap_small_skip': 'DCF \u4f30\u503c\u4e0e\u5f53\u524d\u80a1\u4ef7\u5dee\u5f02\u4e3a {gap:+.1f}%\uff0c\u4f4e\u4e8e {min:g}% \u9608\u503c\uff0c\u672a\u8fdb\u884c AI \u5dee\u5f02\u5206\u6790\u3002',
 
         # ── Error / warning messages ──
         'err_no_fmp_key': (
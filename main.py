@@ -5,10 +5,10 @@ import os
 import re
 import sys
 from datetime import date
-from modeling.data import get_historical_financials, get_company_share_float, fetch_company_profile, fetch_forex_data, format_summary_df, validate_ticker, _normalize_ticker, is_a_share, is_hk_stock, is_jpn_stock, _fill_profile_from_financial_data, _calculate_beta_akshare
+from modeling.data import get_historical_financials, get_company_share_float, fetch_company_profile, fetch_forex_data, format_summary_df, set_data_cache, validate_ticker, _normalize_ticker, is_a_share, is_hk_stock, is_jpn_stock, _fill_profile_from_financial_data, _calculate_beta_akshare
 from modeling.dcf import calculate_dcf, print_dcf_results, sensitivity_analysis, print_sensitivity_table, wacc_sensitivity_analysis, print_wacc_sensitivity, calculate_wacc, print_wacc_details, get_risk_free_rate
 from modeling.constants import HISTORICAL_DATA_PERIODS_ANNUAL, HISTORICAL_DATA_PERIODS_QUARTER, TERMINAL_RISK_PREMIUM, TERMINAL_RONIC_PREMIUM
-from modeling.ai_analyst import analyze_company, interactive_review, analyze_valuation_gap, _AI_ENGINE, set_ai_engine, _ai_engine_display_name
+from modeling.ai_analyst import analyze_company, interactive_review, analyze_valuation_gap, prefetch_valuation_gap, cancel_gap_prefetch, _AI_ENGINE, set_ai_engine, set_gap_cache, _ai_engine_display_name
 from modeling import excel_export as _excel
 from modeling.excel_export import write_to_excel, init_paths as _init_excel_paths
 from modeling import style as S
@@ -36,6 +36,13 @@ def _input_float(prompt_text, default=None):
             print(S.error(f"  输入无效，请输入数字。"))
 
 
+_AI_PARAM_KEYS = (
+    "revenue_growth_1", "revenue_growth_2", "ebit_margin", "convergence",
+    "revenue_invested_capital_ratio_1", "revenue_invested_capital_ratio_2",
+    "revenue_invested_capital_ratio_3", "tax_rate", "wacc",
+)
+
+
 def _auto_accept_params(ai_result):
     """Extract AI-suggested parameters without interactive confirmation.
 
@@ -50,15 +57,9 @@ def _auto_accept_params(ai_result):
         print(S.divider())
         return None
 
-    param_keys = [
-        "revenue_growth_1", "revenue_growth_2", "ebit_margin", "convergence",
-        "revenue_invested_capital_ratio_1", "revenue_invested_capital_ratio_2",
-        "revenue_invested_capital_ratio_3", "tax_rate", "wacc",
-    ]
-
     final_params = {}
     print(f"\n{S.header('Auto 模式: 直接采用 AI 建议参数')}")
-    for key in param_keys:
+    for key in _AI_PARAM_KEYS:
         param_data = params.get(key, {})
         if isinstance(param_data, dict):
             value = param_data.get("value")
@@ -82,6 +83,28 @@ def _auto_accept_params(ai_result):
     return final_params
 
 
+def _draft_ai_params(ai_result):
+    """AI-suggested parameters as interactive_review() returns them when every
+    suggestion is accepted, or None if any is missing. Prints nothing."""
+    params = ai_result.get("parameters")
+    if not isinstance(params, dict):
+        return None
+    draft = {}
+    for key in _AI_PARAM_KEYS:
+        param_data = params.get(key, {})
+        value = param_data.get("value") if isinstance(param_data, dict) else param_data
+        try:
+            draft[key] = float(value)
+        except (TypeError, ValueError):
+            return None
+    ronic_data = params.get("ronic_match_wacc", {})
+    if isinstance(ronic_data, dict):
+        draft["ronic_match_wacc"] = ronic_data.get("value", True)
+    else:
+        draft["ronic_match_wacc"] = ronic_data if isinstance(ronic_data, bool) else True
+    return draft
+
+
 # ────────────────────────────────────────────────────────────────────
 # Input collection
 # ────────────────────────────────────────────────────────────────────
@@ -247,6 +270,17 @@ def _collect_manual_params(average_tax_rate, wacc, wacc_details, risk_free_rate)
 # Valuation parameter building
 # ────────────────────────────────────────────────────────────────────
 
+def _raw_params_from_ai(ai_params, risk_free_rate):
+    """Return a copy of *ai_params* with the ronic_match_wacc flag turned into a RONIC rate."""
+    raw_params = dict(ai_params)
+    if raw_params.pop("ronic_match_wacc", True):
+        ronic = risk_free_rate + TERMINAL_RISK_PREMIUM
+    else:
+        ronic = risk_free_rate + TERMINAL_RISK_PREMIUM + TERMINAL_RONIC_PREMIUM
+    raw_params['ronic'] = ronic
+    return raw_params
+
+
 def _build_valuation_params(raw_params, base_year, risk_free_rate, _is_ttm, _ttm_quarter, _ttm_label):
     """Build the full valuation_params dict from raw parameter values."""
     return {
@@ -316,6 +350,28 @@ def _compute_forex_rate(results, company_profile, apikey):
         return None
 
 
+def _start_gap_prefetch(ai_result, ticker, base_year_data, financial_data, company_info,
+                        company_profile, summary_df, base_year, forecast_year_1, forex_rate,
+                        risk_free_rate, _is_ttm, _ttm_quarter, _ttm_label):
+    """Start the gap analysis for the AI's own parameters in the background,
+    so it runs while the user reviews them (reused if every suggestion is
+    accepted). Opt-in via --prefetch-gap; a failure skips the prefetch."""
+    try:
+        draft_params = _draft_ai_params(ai_result)
+        if draft_params is None:
+            return
+        draft_valuation = _build_valuation_params(
+            _raw_params_from_ai(draft_params, risk_free_rate),
+            base_year, risk_free_rate, _is_ttm, _ttm_quarter, _ttm_label)
+        draft_results = calculate_dcf(base_year_data, draft_valuation, financial_data,
+                                      company_info, company_profile)
+        prefetch_valuation_gap(ticker, company_profile, draft_results, draft_valuation,
+                               summary_df, base_year, forecast_year_1=forecast_year_1,
+                               forex_rate=forex_rate)
+    except Exception as e:
+        print(S.muted(f"  ⓘ 差异分析预取未启动: {e}"))
+
+
 def _run_gap_analysis(auto_mode, ticker, company_profile, results, valuation_params,
                       summary_df, base_year, forecast_year_1, forex_rate):
     """Run AI gap analysis if requested. Returns gap_analysis_result or None."""
@@ -336,6 +392,8 @@ def _run_gap_analysis(auto_mode, ticker, company_profile, results, valuation_par
                                          forex_rate=forex_rate)
         except Exception as e:
             print(f"\n{S.error(f'估值差异分析出错: {e}')}")
+    else:
+        cancel_gap_prefetch()
     return None
 
 
@@ -525,6 +583,10 @@ def main(args):
                         print(S.error("Auto 模式: AI 参数解析失败，退出。"))
                         sys.exit(1)
                 else:
+                    if getattr(args, 'prefetch_gap', False):
+                        _start_gap_prefetch(ai_result, ticker, base_year_data, financial_data, company_info,
+                                            company_profile, summary_df, base_year, forecast_year_1, forex_rate,
+                                            risk_free_rate, _is_ttm, _ttm_quarter, _ttm_label)
                     ai_params = interactive_review(ai_result, wacc, average_tax_rate, company_profile, wacc_details)
             except Exception as e:
                 print(f"\n{S.error(f'AI 分析出错: {e}')}")
@@ -533,12 +595,7 @@ def main(args):
                 print(S.warning("自动回退到手工输入模式...\n"))
 
         if ai_params is not None:
-            ronic_match = ai_params.pop("ronic_match_wacc", True)
-            if ronic_match:
-                ronic = risk_free_rate + TERMINAL_RISK_PREMIUM
-            else:
-                ronic = risk_free_rate + TERMINAL_RISK_PREMIUM + TERMINAL_RONIC_PREMIUM
-            raw_params = {**ai_params, 'ronic': ronic}
+            raw_params = _raw_params_from_ai(ai_params, risk_free_rate)
         else:
             raw_params = _collect_manual_params(average_tax_rate, wacc, wacc_details, risk_free_rate)
 
@@ -628,10 +685,23 @@ if __name__ == '__main__':
 
     parser.add_argument('--engine', choices=['claude', 'gemini', 'qwen'], help='Force a specific AI engine (default: auto-detect)')
 
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument('--no-cache', action='store_true', help='Do not read or write cached AI gap analysis results or FMP statements')
+    cache_group.add_argument('--refresh-cache', action='store_true', help='Ignore cached AI gap analysis results and FMP statements, and store fresh ones')
+
+    parser.add_argument('--prefetch-gap', action='store_true',
+                        help='Run the AI gap analysis in the background while you review parameters (may spend an extra AI call)')
+
     args = parser.parse_args()
 
     # Apply --engine override before main()
     if args.engine:
         set_ai_engine(args.engine)
+    if args.no_cache:
+        set_gap_cache('off')
+        set_data_cache('off')
+    elif args.refresh_cache:
+        set_gap_cache('refresh')
+        set_data_cache('refresh')
 
     main(args)
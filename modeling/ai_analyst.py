@@ -1,17 +1,44 @@
 # Copyright (c) 2025 Alan He. Licensed under MIT.
 
+import atexit
+import functools
+import hashlib
+import io
 import json
+import math
 import os
 import re
+import selectors
 import shutil
+import string
 import subprocess
 import sys
+import tempfile
+import textwrap
 import threading
 import time
+import types
 import unicodedata
-from contextlib import contextmanager
+import weakref
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager, redirect_stdout
 from datetime import date
+
+import numpy as np
+
 from . import style as S
+from .constants import MIN_GAP_PCT
+from .dcf import print_wacc_details
+
+# orjson is an optional speedup for parsing the CLI JSON envelopes and the
+# fenced parameter block; its JSONDecodeError subclasses
+# json.JSONDecodeError, so handlers are unchanged.
+try:
+    import orjson as _orjson
+    _json_loads = _orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 # ---------------------------------------------------------------------------
 # AI Engine detection: Claude CLI → Gemini CLI → Qwen Code CLI (fallback)
@@ -19,7 +46,8 @@ from . import style as S
 # ---------------------------------------------------------------------------
 
 # Supported engines: 'claude', 'gemini', 'qwen'
-_ENGINE_LABELS = {'claude': 'Claude CLI', 'gemini': 'Gemini CLI', 'qwen': 'Qwen Code CLI'}
+_ENGINE_LABELS = types.MappingProxyType(
+    {'claude': 'Claude CLI', 'gemini': 'Gemini CLI', 'qwen': 'Qwen Code CLI'})
 
 # ---------------------------------------------------------------------------
 # Terminal progress display during AI calls
@@ -27,6 +55,8 @@ _ENGINE_LABELS = {'claude': 'Claude CLI', 'gemini': 'Gemini CLI', 'qwen': 'Qwen
 
 _SPINNER_CHARS = '⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏'
 _CLEAR_EOL = '\033[K'
+# Line prefix for each spinner frame, built once for _progress_tick()
+_SPINNER_FRAMES = tuple(f'\r  {c} ' for c in _SPINNER_CHARS)
 
 _PROGRESS_MESSAGES = [
     '正在初始化 AI 引擎...',
@@ -41,14 +71,27 @@ _PROGRESS_MESSAGES = [
 ]
 
 # Shared mutable state so _call_ai_cli can update engine label / reset
-# timer on fallback while the progress thread is running.
+# timer on fallback while the progress spinner is running.
 _progress_state = {
     'engine_label': '',
     'start_time': 0.0,
     'active': False,   # True while a progress spinner is running
     'paused': False,    # True while a message is being printed over the spinner
+    'tty': False,       # stdout is a terminal (spinner is skipped when piped)
+    'frame': 0,         # spinner frame counter
+    'next_draw': 0.0,   # monotonic time of the next allowed redraw
 }
 
+# Minimum interval between spinner redraws, in seconds
+_SPINNER_INTERVAL = 0.1
+
+
+# Per-thread flags; 'quiet' is set on background (prefetch) threads so their
+# engine errors don't interleave with the user's input (they are collected
+# in 'log' instead and reported later), and 'no_spinner' on worker threads
+# so only the thread waiting on them draws the spinner.
+_thread_flags = threading.local()
+
 
 def _print_progress_safe(msg):
     """Print a message without garbling the progress spinner.
@@ -56,6 +99,11 @@ def _print_progress_safe(msg):
     If the spinner is active, temporarily pause it, clear its line,
     print the message, then resume.
     """
+    if getattr(_thread_flags, 'quiet', False):
+        log = getattr(_thread_flags, 'log', None)
+        if log is not None:
+            log.append(msg)
+        return
     if _progress_state['active']:
         _progress_state['paused'] = True
         sys.stdout.write(f'\r{_CLEAR_EOL}')
@@ -66,73 +114,88 @@ def _print_progress_safe(msg):
         print(msg)
 
 
-def _progress_display(stop_event, failed):
-    """Show a live spinner + elapsed time + rotating status message.
+def _progress_tick():
+    """Redraw the live spinner + elapsed time + rotating status message.
 
-    Runs in a background daemon thread. Uses \\r to update in place.
-    Reads engine_label and start_time from _progress_state so they
-    can be updated on engine fallback.
-    """
-    if not hasattr(sys.stdout, 'isatty') or not sys.stdout.isatty():
-        return  # skip when output is piped
-
-    idx = 0
+    Called from the CLI output read loop (see _read_process_output) each
+    time it wakes up, so no dedicated spinner thread is needed. Uses \\r
+    to update in place and is throttled to one redraw per _SPINNER_INTERVAL.
 
+    Returns:
+        Seconds until the next redraw is due, or None when no spinner is
+        being drawn — the read loop uses this as its wait timeout so it
+        wakes only when there is something to draw.
+    """
+    state = _progress_state
+    if not state['active'] or not state['tty'] or getattr(_thread_flags, 'no_spinner', False):
+        return None
+    if state['paused']:
+        return _SPINNER_INTERVAL
+    now = time.monotonic()
+    if now < state['next_draw']:
+        return state['next_draw'] - now
+    state['next_draw'] = now + _SPINNER_INTERVAL
+
+    elapsed = now - state['start_time']
+    msg_idx = min(int(elapsed / 12), len(_PROGRESS_MESSAGES) - 1)
+    frame = _SPINNER_FRAMES[state['frame'] % len(_SPINNER_FRAMES)]
+    state['frame'] += 1
+    line = f'{frame}{_PROGRESS_MESSAGES[msg_idx]}  ({state["engine_label"]} · {int(elapsed)}s){_CLEAR_EOL}'
     try:
-        while not stop_event.is_set():
-            if _progress_state['paused']:
-                stop_event.wait(0.1)
-                continue
-            engine_label = _progress_state['engine_label']
-            elapsed = time.monotonic() - _progress_state['start_time']
-            msg_idx = min(int(elapsed / 12), len(_PROGRESS_MESSAGES) - 1)
-            spinner = _SPINNER_CHARS[idx % len(_SPINNER_CHARS)]
-            elapsed_str = f'{int(elapsed)}s'
-            line = f'\r  {spinner} {_PROGRESS_MESSAGES[msg_idx]}  ({engine_label} · {elapsed_str}){_CLEAR_EOL}'
-            sys.stdout.write(line)
-            sys.stdout.flush()
-            idx += 1
-            stop_event.wait(0.1)
-
-        # Clean up: clear line then print final message
-        engine_label = _progress_state['engine_label']
-        elapsed = time.monotonic() - _progress_state['start_time']
-        elapsed_str = f'{int(elapsed)}s'
-        sys.stdout.write(f'\r{_CLEAR_EOL}')
+        sys.stdout.write(line)
         sys.stdout.flush()
-        if not failed[0]:
-            print(f"  {S.success('✓')} {S.ai_label('AI 分析完成')}  {S.muted(f'({engine_label} · {elapsed_str})')}")
     except (IOError, OSError):
         pass  # stdout closed unexpectedly
+    return _SPINNER_INTERVAL
 
 
-@contextmanager
-def _with_progress(engine_label):
-    """Context manager that shows a live progress spinner during AI calls."""
+def _start_progress(engine_label):
     _progress_state['engine_label'] = engine_label
     _progress_state['start_time'] = time.monotonic()
     _progress_state['active'] = True
     _progress_state['paused'] = False
+    _progress_state['tty'] = hasattr(sys.stdout, 'isatty') and sys.stdout.isatty()
+    _progress_state['frame'] = 0
+    _progress_state['next_draw'] = 0.0
+
+
+def _finish_progress(failed):
+    _progress_state['active'] = False
+    if _progress_state['tty']:
+        # Clean up: clear line then print final message
+        engine_label = _progress_state['engine_label']
+        elapsed_str = f"{int(time.monotonic() - _progress_state['start_time'])}s"
+        try:
+            sys.stdout.write(f'\r{_CLEAR_EOL}')
+            sys.stdout.flush()
+            if not failed:
+                print(f"  {S.success('✓')} {S.ai_label('AI 分析完成')}  {S.muted(f'({engine_label} · {elapsed_str})')}")
+        except (IOError, OSError):
+            pass  # stdout closed unexpectedly
+
+
+@contextmanager
+def _with_progress(engine_label):
+    """Context manager that shows a live progress spinner during AI calls.
 
-    stop_event = threading.Event()
-    failed = [False]
-    t = threading.Thread(target=_progress_display,
-                         args=(stop_event, failed),
-                         daemon=True)
-    t.start()
+    The spinner is drawn by _progress_tick() from the subprocess read loop;
+    on exit the line is cleared and a completion message is printed.
+    Reads engine_label and start_time from _progress_state so they can be
+    updated on engine fallback.
+    """
+    _start_progress(engine_label)
+    failed = False
     try:
         yield
     except Exception:
-        failed[0] = True
+        failed = True
         raise
     finally:
-        stop_event.set()
-        t.join(timeout=2.0)
-        _progress_state['active'] = False
+        _finish_progress(failed)
 
 
 # Claude model ID → human-friendly display name
-_CLAUDE_MODEL_DISPLAY = {
+_CLAUDE_MODEL_DISPLAY = types.MappingProxyType({
     'claude-opus-4-6': 'Claude Opus 4.6',
     'claude-opus-4-5-20251101': 'Claude Opus 4.5',
     'claude-opus-4-5': 'Claude Opus 4.5',
@@ -140,19 +203,28 @@ _CLAUDE_MODEL_DISPLAY = {
     'claude-sonnet-4-5-20250929': 'Claude Sonnet 4.5',
     'claude-sonnet-4-5': 'Claude Sonnet 4.5',
     'claude-sonnet-4-20250514': 'Claude Sonnet 4',
-}
+})
 
 # Gemini: 'pro' alias resolves to latest Pro model.
 # previewFeatures must be enabled for Gemini 3 — we auto-configure this.
 GEMINI_MODEL = 'pro'
 
 
+# Set once previewFeatures has been confirmed (or written) in this process,
+# so engine detection / fallback don't re-read settings.json every time.
+_gemini_preview_verified = False
+
+
 def _ensure_gemini_preview():
     """Ensure Gemini CLI has previewFeatures enabled in ~/.gemini/settings.json.
 
     This is required for the 'pro' alias to resolve to the latest model
     (e.g. Gemini 3 Pro) instead of being stuck on Gemini 2.5 Pro.
     """
+    global _gemini_preview_verified
+    if _gemini_preview_verified:
+        return
+
     settings_dir = os.path.expanduser('~/.gemini')
     settings_path = os.path.join(settings_dir, 'settings.json')
 
@@ -166,14 +238,56 @@ def _ensure_gemini_preview():
 
     general = settings.get('general', {})
     if general.get('previewFeatures') is True:
+        _gemini_preview_verified = True
         return  # already enabled
 
     general['previewFeatures'] = True
     settings['general'] = general
 
-    os.makedirs(settings_dir, exist_ok=True)
-    with open(settings_path, 'w') as f:
-        json.dump(settings, f, indent=2)
+    # Write to a uniquely named temp file in the same directory and rename
+    # it over the original, so a crash mid-write (or a concurrent run) can
+    # never leave a truncated settings.json behind. A failed write is not
+    # fatal — Gemini still runs, just on the older default model — and the
+    # flag stays unset so the next call retries.
+    tmp_path = None
+    try:
+        os.makedirs(settings_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='settings.', suffix='.tmp', dir=settings_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(settings, f, indent=2)
+        os.replace(tmp_path, settings_path)
+    except OSError:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return
+    _gemini_preview_verified = True
+
+
+# shutil.which() stats every $PATH entry on each call; memoize hits per
+# (cmd, PATH) so repeated engine checks and fallbacks cost nothing while
+# still noticing a changed PATH. Misses are not cached, so a CLI installed
+# while the process (e.g. the web app) is running is picked up.
+_which_cache = {}
+
+
+def _cached_which(cmd, path):
+    key = (cmd, path)
+    resolved = _which_cache.get(key)
+    if resolved is None:
+        resolved = shutil.which(cmd, path=path)
+        if resolved:
+            _which_cache[key] = resolved
+    return resolved
+
+
+def _which(cmd):
+    return _cached_which(cmd, os.environ.get('PATH'))
+
+
+def _available_engines():
+    """Installed engines in priority order."""
+    path = os.environ.get('PATH')
+    return tuple(e for e in ('claude', 'gemini', 'qwen') if _cached_which(e, path))
 
 
 def _detect_ai_engine():
@@ -182,14 +296,12 @@ def _detect_ai_engine():
     Returns 'claude', 'gemini', 'qwen', or None.
     Priority: Claude CLI > Gemini CLI > Qwen Code CLI.
     """
-    if shutil.which('claude'):
-        return 'claude'
-    if shutil.which('gemini'):
+    engines = _available_engines()
+    if not engines:
+        return None
+    if engines[0] == 'gemini':
         _ensure_gemini_preview()
-        return 'gemini'
-    if shutil.which('qwen'):
-        return 'qwen'
-    return None
+    return engines[0]
 
 _AI_ENGINE = _detect_ai_engine()
 
@@ -205,32 +317,35 @@ def set_ai_engine(engine):
     Raises:
         RuntimeError: If the requested CLI is not installed.
     """
-    global _AI_ENGINE, _detected_model_name
+    global _AI_ENGINE, _detected_model_name, _CLEAN_ENV_CACHE
     _install_hints = {
         'claude': "Claude CLI 未安装。请先安装: https://docs.anthropic.com/en/docs/claude-code",
         'gemini': "Gemini CLI 未安装。请先安装: npm install -g @google/gemini-cli",
         'qwen':   "Qwen Code CLI 未安装。请先安装: npm install -g @qwen-code/qwen-code",
     }
-    cmd_name = 'qwen' if engine == 'qwen' else engine
-    if not shutil.which(cmd_name):
+    if not _which(engine):
         raise RuntimeError(_install_hints[engine])
     if engine == 'gemini':
         _ensure_gemini_preview()
     _AI_ENGINE = engine
     _detected_model_name = None  # reset so first call re-detects
+    _CLEAN_ENV_CACHE = None      # pick up env changes made since last call
+
+
+# Fallback display names until the actual model is detected from CLI output
+_DEFAULT_LATEST = types.MappingProxyType({
+    'claude': 'Claude (latest)',
+    'gemini': 'Gemini (latest)',
+    'qwen': 'Qwen (latest)',
+})
 
 
 def _ai_engine_display_name():
     """Return human-friendly display name for the active AI engine."""
-    if _detected_model_name:
-        return _detected_model_name
-    if _AI_ENGINE == 'claude':
-        return 'Claude (latest)'
-    elif _AI_ENGINE == 'gemini':
-        return 'Gemini (latest)'
-    elif _AI_ENGINE == 'qwen':
-        return 'Qwen (latest)'
-    return 'N/A'
+    return _detected_model_name or _DEFAULT_LATEST.get(_AI_ENGINE, 'N/A')
+
+
+_RE_JSON_MESSAGE = re.compile(r'"message"\s*:\s*"([^"]+)"')
 
 
 def _extract_error_message(raw_error):
@@ -239,15 +354,22 @@ def _extract_error_message(raw_error):
     Gemini CLI errors include full stack traces and JSON responses.
     This extracts just the key message (e.g. "No capacity available for model...").
     """
-    # Try to find the core error message in JSON
-    m = re.search(r'"message"\s*:\s*"([^"]+)"', raw_error)
+    # Try to find the core error message in JSON (it sits near the top;
+    # don't scan megabytes of trailing stack trace for it)
+    m = _RE_JSON_MESSAGE.search(raw_error, 0, 4096)
     if m:
         return m.group(1)
-    # Fallback: first non-empty line, capped at 200 chars
-    for line in raw_error.split('\n'):
-        line = line.strip()
+    # Fallback: first non-empty line, capped at 200 chars. Walk line by
+    # line rather than split() so a huge trace isn't materialized.
+    start = 0
+    while start < len(raw_error):
+        end = raw_error.find('\n', start)
+        if end == -1:
+            end = len(raw_error)
+        line = raw_error[start:end].strip()
         if line and not line.startswith(('at ', 'Hook ', 'Loaded ')):
             return line[:200]
+        start = end + 1
     return raw_error[:200]
 
 
@@ -272,58 +394,254 @@ def _auth_error_hint(engine, raw_err):
     return ""
 
 
-def _run_engine(engine, prompt):
-    """Run a single AI engine and return (raw_stdout, engine_name) or None on failure.
+# Subprocess environment for the AI CLIs, built once and reused by every
+# _run_engine call (reset by set_ai_engine).  Treat as read-only.
+_CLEAN_ENV_CACHE = None
 
-    This is a low-level helper — it does NOT do fallback. The caller (_call_ai_cli)
-    handles fallback logic.
+
+def _get_clean_env():
+    """Return the cached subprocess env for AI CLI calls.
+
+    A copy of os.environ with CLAUDE* markers removed, to avoid the
+    "nested session" error when launched from Claude Code.
     """
-    engine_label = _ENGINE_LABELS.get(engine, engine)
+    global _CLEAN_ENV_CACHE
+    if _CLEAN_ENV_CACHE is None:
+        clean_env = os.environ.copy()
+        for k in [k for k in clean_env if k.startswith('CLAUDE')]:
+            del clean_env[k]
+        _CLEAN_ENV_CACHE = clean_env
+    return _CLEAN_ENV_CACHE
+
+
+# Sentinel for "key absent" when unwrapping CLI JSON envelopes
+_MISSING = object()
+
+# CLI output limits: output is read in 64 KB chunks and the process is
+# killed if stdout grows past 8 MB (a runaway / corrupted response).
+# Between chunks the read loop sleeps until the next spinner frame or the
+# deadline; on Windows, where output arrives on reader threads, it also
+# wakes every _POLL_INTERVAL seconds to check the size cap.
+_READ_CHUNK = 64 << 10
+_MAX_OUTPUT = 8 << 20
+_POLL_INTERVAL = 0.25
+
+
+def _read_process_output(proc, timeout, stdin_data=b''):
+    """Feed *stdin_data* to *proc* and drain its stdout/stderr, enforcing a
+    deadline and size cap.
+
+    Output is accumulated chunk by chunk into bytearrays. The loop also
+    drives the progress spinner via _progress_tick(). On POSIX the pipes
+    are multiplexed with selectors on the calling thread; Windows can't
+    select() on pipes, so there the pipes are served by helper threads
+    while the calling thread polls the process.
+
+    Returns:
+        (stdout_bytes, stderr_bytes, status) — status is 'ok', 'timeout'
+        or 'overflow'.
+    """
+    deadline = time.monotonic() + timeout
+    if sys.platform == 'win32':
+        out_buf, err_buf, status = _drain_pipes_threaded(proc, deadline, stdin_data)
+    else:
+        out_buf, err_buf, status = _drain_pipes_select(proc, deadline, stdin_data)
+
+    if status != 'ok':
+        proc.kill()
+    proc.wait()
+    if proc.stdin is not None:
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass  # child exited without reading all of stdin
+    proc.stdout.close()
+    proc.stderr.close()
+    return bytes(out_buf), bytes(err_buf), status
+
+
+def _drain_pipes_select(proc, deadline, stdin_data):
+    """POSIX read loop for _read_process_output (single thread, selectors)."""
+    out_buf = bytearray()
+    err_buf = bytearray()
+    bufs = {proc.stdout.fileno(): out_buf, proc.stderr.fileno(): err_buf}
+    pending = memoryview(stdin_data)
+    with selectors.DefaultSelector() as sel:
+        sel.register(proc.stdout, selectors.EVENT_READ)
+        sel.register(proc.stderr, selectors.EVENT_READ)
+        if proc.stdin is not None:
+            if pending:
+                # Non-blocking so a prompt larger than the pipe buffer is
+                # written in pieces, interleaved with reading the output.
+                os.set_blocking(proc.stdin.fileno(), False)
+                sel.register(proc.stdin, selectors.EVENT_WRITE)
+            else:
+                proc.stdin.close()
+        wait = _progress_tick()
+        while sel.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return out_buf, err_buf, 'timeout'
+            for key, _events in sel.select(remaining if wait is None else min(wait, remaining)):
+                if key.fileobj is proc.stdin:
+                    try:
+                        pending = pending[os.write(key.fd, pending):]
+                    except BlockingIOError:
+                        continue
+                    except BrokenPipeError:
+                        pending = pending[:0]  # child stopped reading
+                    if not pending:
+                        sel.unregister(proc.stdin)
+                        proc.stdin.close()
+                    continue
+                chunk = os.read(key.fd, _READ_CHUNK)
+                if chunk:
+                    bufs[key.fd].extend(chunk)
+                else:
+                    sel.unregister(key.fileobj)  # EOF
+            wait = _progress_tick()
+            if len(out_buf) > _MAX_OUTPUT:
+                return out_buf, err_buf, 'overflow'
+    return out_buf, err_buf, 'ok'
+
+
+def _drain_pipes_threaded(proc, deadline, stdin_data):
+    """Windows read loop for _read_process_output (reader threads + polling)."""
+    out_buf = bytearray()
+    err_buf = bytearray()
+
+    def _drain(pipe, buf):
+        try:
+            for chunk in iter(lambda: pipe.read1(_READ_CHUNK), b''):
+                buf.extend(chunk)
+        except (OSError, ValueError):
+            pass  # pipe closed after kill
 
+    def _feed(pipe, data):
+        try:
+            if data:
+                pipe.write(data)
+            pipe.close()
+        except (OSError, ValueError):
+            pass  # child exited without reading all of stdin
+
+    readers = [threading.Thread(target=_drain, args=(proc.stdout, out_buf), daemon=True),
+               threading.Thread(target=_drain, args=(proc.stderr, err_buf), daemon=True)]
+    if proc.stdin is not None:
+        readers.append(threading.Thread(target=_feed, args=(proc.stdin, stdin_data), daemon=True))
+    for t in readers:
+        t.start()
+    status = 'ok'
+    wait = _progress_tick()
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            status = 'timeout'
+            break
+        try:
+            proc.wait(timeout=min(wait or _POLL_INTERVAL, _POLL_INTERVAL, remaining))
+            break
+        except subprocess.TimeoutExpired:
+            pass
+        wait = _progress_tick()
+        if len(out_buf) > _MAX_OUTPUT:
+            status = 'overflow'
+            break
+    if status != 'ok':
+        proc.kill()
+    for t in readers:
+        t.join(timeout=2.0)
+    return out_buf, err_buf, status
+
+
+class _EngineRace:
+    """Shared state for engines racing each other during fallback.
+
+    Each _run_engine call spawns its process through spawn(); once a winner
+    is found, cancel() kills every other process and stops new ones from
+    starting.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._procs = []
+        self.cancelled = False
+
+    def spawn(self, cmd, **kwargs):
+        """Start *cmd* unless the race is already over. Returns Popen or None."""
+        with self._lock:
+            if self.cancelled:
+                return None
+            proc = subprocess.Popen(cmd, **kwargs)
+            self._procs.append(proc)
+            return proc
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            for proc in self._procs:
+                if proc.poll() is None:
+                    proc.kill()
+
+
+# Per-call CLI timeout: 10 minutes for search + analysis
+_ENGINE_TIMEOUT = 600
+
+
+def _engine_command(engine, prompt):
+    """Return (argv, stdin_data) for running *prompt* (UTF-8 bytes) on *engine*.
+
+    Returns None (after reporting it) if the engine is unknown. stdin_data
+    is None when the prompt travels on argv; stdin is then /dev/null.
+    """
+    # claude: -p is just the print-mode switch and the prompt is read from
+    # stdin, so its size isn't bounded by the OS command-line limit.
+    # gemini/qwen: the prompt is passed with -p, as these CLIs document.
     if engine == 'claude':
-        cmd = ['claude', '-p', prompt, '--output-format', 'json',
+        cmd = ['claude', '-p', '--output-format', 'json',
                '--allowedTools', 'WebSearch,WebFetch']
+        stdin_data = prompt
     elif engine == 'gemini':
-        cmd = ['gemini', '-p', prompt, '--output-format', 'json', '-m', GEMINI_MODEL]
+        cmd = ['gemini', '-p', prompt.decode('utf-8'), '--output-format', 'json', '-m', GEMINI_MODEL]
+        stdin_data = None
     elif engine == 'qwen':
-        cmd = ['qwen', '-p', prompt, '--output-format', 'json']
+        cmd = ['qwen', '-p', prompt.decode('utf-8'), '--output-format', 'json']
+        stdin_data = None
     else:
         _print_progress_safe(f"  {S.error(f'未知引擎: {engine}')}")
         return None
 
-    _timeout = 600  # 10 minutes for search + analysis
-    # Build a clean env without CLAUDE* markers to avoid
-    # "nested session" error when launched from Claude Code.
-    clean_env = {k: v for k, v in os.environ.items()
-                 if not k.startswith('CLAUDE')}
-    for _ek in ('PATH', 'HOME', 'USER', 'SHELL', 'LANG', 'TERM',
-                'FMP_API_KEY', 'GEMINI_API_KEY', 'OPENAI_API_KEY',
-                'DASHSCOPE_API_KEY',
-                # Windows-required env vars
-                'SYSTEMROOT', 'COMSPEC', 'PATHEXT', 'TEMP', 'TMP',
-                'APPDATA', 'LOCALAPPDATA', 'USERPROFILE', 'HOMEDRIVE',
-                'HOMEPATH', 'SYSTEMDRIVE', 'WINDIR'):
-        if _ek in os.environ:
-            clean_env[_ek] = os.environ[_ek]
-    # On Windows, npm global installs create .cmd wrappers (e.g. qwen.cmd).
-    # subprocess.run() won't find .cmd files without shell=True,
-    # so resolve the full path via shutil.which() first.
-    _is_windows = sys.platform == 'win32'
-    if _is_windows:
-        resolved = shutil.which(cmd[0])
-        if resolved:
-            cmd[0] = resolved
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True,
-                                timeout=_timeout, env=clean_env,
-                                shell=_is_windows, encoding='utf-8',
-                                errors='replace')
-    except subprocess.TimeoutExpired:
-        _print_progress_safe(f"  {S.warning(f'{engine_label} 调用超时 ({_timeout}s)')}")
+    # Resolve the full executable path via (cached) shutil.which() first:
+    # - Windows: npm global installs create .cmd wrappers (e.g. qwen.cmd),
+    #   which subprocess won't find without shell=True.
+    # - POSIX: an absolute path plus close_fds=False lets subprocess use
+    #   posix_spawn() instead of fork()+exec(), skipping the per-fd close
+    #   loop in the child. Safe because Python's own fds are created
+    #   non-inheritable (PEP 446).
+    resolved = _which(cmd[0])
+    if resolved:
+        cmd[0] = resolved
+    return cmd, stdin_data
+
+
+def _engine_result(engine, returncode, out, err, status):
+    """Check a finished CLI run; return (out, engine, parsed_json) or None.
+
+    Failures (timeout, size cap, non-zero exit, empty output, Claude
+    is_error envelopes) are reported here, in one place.
+    """
+    engine_label = _ENGINE_LABELS.get(engine, engine)
+    if status == 'timeout':
+        _print_progress_safe(f"  {S.warning(f'{engine_label} 调用超时 ({_ENGINE_TIMEOUT}s)')}")
+        return None
+    if status == 'overflow':
+        _print_progress_safe(f"  {S.warning(f'{engine_label} 输出超过 {_MAX_OUTPUT >> 20} MB 上限，已终止')}")
         return None
 
-    if result.returncode != 0:
-        raw_err = result.stderr.strip() or result.stdout.strip() or "Unknown error"
+    if returncode != 0:
+        raw_err = (err.decode('utf-8', errors='replace').strip()
+                   or out.decode('utf-8', errors='replace').strip()
+                   or "Unknown error")
         error_msg = _extract_error_message(raw_err)
         _print_progress_safe(f"  {S.warning(f'{engine_label} 调用失败: {error_msg}')}")
         # Show actionable fix hints for common auth errors
@@ -332,24 +650,190 @@ def _run_engine(engine, prompt):
             _print_progress_safe(f"  {S.muted(_hints)}")
         return None
 
-    raw = result.stdout.strip()
-    if not raw:
+    if not out or out.isspace():
         _print_progress_safe(f"  {S.warning(f'{engine_label} 返回空内容')}")
         return None
 
+    # Parse the JSON envelope once, straight from the bytes (the parser
+    # skips surrounding whitespace, so no decode/strip copy is needed).
+    try:
+        data = _json_loads(out)
+    except ValueError:  # JSONDecodeError, or invalid UTF-8
+        data = None
+
     # Claude CLI may return exit code 0 but with is_error:true in JSON
     # (e.g. rate limit hit). Detect this and treat as failure so fallback kicks in.
-    if engine == 'claude':
+    if engine == 'claude' and isinstance(data, dict) and data.get('is_error'):
+        error_msg = data.get('result', '') or 'Unknown error'
+        _print_progress_safe(f"  {S.warning(f'{engine_label} 调用失败: {error_msg}')}")
+        return None
+
+    return (out, engine, data)
+
+
+def _run_engine(engine, prompt, race=None):
+    """Run a single AI engine and return (stdout_bytes, engine_name, parsed_json) or None on failure.
+
+    *prompt* is the UTF-8 encoded prompt. Claude reads it from stdin, so its
+    size isn't bounded by the OS command-line limit (notably ~8 KB through
+    cmd.exe on Windows); gemini/qwen take it on argv via -p.
+    parsed_json is the decoded JSON envelope, or None if stdout isn't JSON.
+
+    This is a low-level helper — it does NOT do fallback. The caller (_call_ai_cli)
+    handles fallback logic.  When *race* (an _EngineRace) is given, the process
+    is registered with it so it can be killed once another engine wins.
+    """
+    command = _engine_command(engine, prompt)
+    if command is None:
+        return None
+    cmd, stdin_data = command
+
+    _is_windows = sys.platform == 'win32'
+    # Stream stdout instead of capture_output=True so large responses are
+    # accumulated incrementally, capped at _MAX_OUTPUT, and decoded once.
+    # Engines that take the prompt on argv get /dev/null, never the terminal:
+    # a prefetch run would otherwise compete with input() for keystrokes.
+    popen_kwargs = dict(stdin=subprocess.DEVNULL if stdin_data is None else subprocess.PIPE,
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                        env=_get_clean_env(), shell=_is_windows)
+    if not _is_windows:
+        popen_kwargs['close_fds'] = False
+    if race is None:
+        proc = subprocess.Popen(cmd, **popen_kwargs)
+    else:
+        proc = race.spawn(cmd, **popen_kwargs)
+        if proc is None:
+            return None  # another engine already won
+    out, err, status = _read_process_output(proc, _ENGINE_TIMEOUT, stdin_data or b'')
+    if race is not None and race.cancelled:
+        return None  # killed because another engine won — not an error
+    return _engine_result(engine, proc.returncode, out, err, status)
+
+
+# At most this many fallback engines run at once; the rest start only if
+# one of them fails, so a fallback never fans out to every paid CLI.
+_MAX_RACING_ENGINES = 2
+
+
+def _race_engine_worker(engine, prompt, race):
+    # The thread waiting in _race_engines draws the spinner, not the workers
+    _thread_flags.no_spinner = True
+    return _run_engine(engine, prompt, race)
+
+
+def _race_engines(engines, prompt):
+    """Run *engines* concurrently and return the first successful result.
+
+    Returns the _run_engine result tuple from the first engine that succeeds,
+    or None if all fail. Slower engines are killed once a winner is found.
+    An engine that raises (e.g. OSError from Popen) counts as failed; the
+    others keep running.
+    """
+    if len(engines) == 1:
+        return _run_engine(engines[0], prompt)
+
+    race = _EngineRace()
+    result = None
+    with ThreadPoolExecutor(max_workers=min(len(engines), _MAX_RACING_ENGINES)) as pool:
+        pending = {pool.submit(_race_engine_worker, e, prompt, race): e for e in engines}
         try:
-            _parsed = json.loads(raw)
-            if isinstance(_parsed, dict) and _parsed.get('is_error'):
-                error_msg = _parsed.get('result', '') or 'Unknown error'
-                _print_progress_safe(f"  {S.warning(f'{engine_label} 调用失败: {error_msg}')}")
-                return None
-        except (json.JSONDecodeError, KeyError):
-            pass  # not JSON or unexpected structure — continue normally
+            while pending and result is None:
+                done, _ = wait(pending, timeout=_progress_tick() or _POLL_INTERVAL,
+                               return_when=FIRST_COMPLETED)
+                for fut in done:
+                    engine = pending.pop(fut)
+                    try:
+                        result = fut.result()
+                    except Exception as e:
+                        engine_label = _ENGINE_LABELS.get(engine, engine)
+                        _print_progress_safe(f"  {S.warning(f'{engine_label} 调用失败: {e}')}")
+                        continue
+                    if result is not None:
+                        break
+        finally:
+            race.cancel()
+    return result
+
+
+_NO_ENGINE_ERROR = (
+    "未检测到可用的 AI 引擎。请安装以下任一工具：\n"
+    "  1. Claude CLI: https://docs.anthropic.com/en/docs/claude-code\n"
+    "  2. Gemini CLI: npm install -g @google/gemini-cli\n"
+    "     （只需 Google 账号登录，免费使用）\n"
+    "  3. Qwen Code:  npm install -g @qwen-code/qwen-code\n"
+    "     （只需 qwen.ai 账号登录，免费使用）"
+)
+
+
+def _begin_fallback(engine):
+    """Announce the switch away from a failed *engine* and return the other
+    installed engines to race (possibly empty)."""
+    global _detected_model_name
+    fallbacks = [fb for fb in _available_engines() if fb != engine]
+    if fallbacks:
+        fallback_labels = ' / '.join(_ENGINE_LABELS.get(fb, fb) for fb in fallbacks)
+        _print_progress_safe(f"  {S.info(f'自动切换到 {fallback_labels} 继续分析...')}")
+        if 'gemini' in fallbacks:
+            _ensure_gemini_preview()
+        _detected_model_name = None
+        # Reset progress display for the fallback engines
+        _progress_state['engine_label'] = fallback_labels
+        _progress_state['start_time'] = time.monotonic()
+    return fallbacks
+
+
+def _adopt_fallback(result):
+    """Make the engine that won a fallback race the active one."""
+    global _AI_ENGINE
+    if result is not None:
+        _AI_ENGINE = result[1]
+        _progress_state['engine_label'] = _ENGINE_LABELS.get(_AI_ENGINE, _AI_ENGINE)
+
+
+def _response_text(result):
+    """Extract the reply text from a _run_engine result tuple.
+
+    Also records the actual model name on first detection.
+    Raises:
+        RuntimeError: If every engine failed or the reply is empty.
+    """
+    global _detected_model_name
+
+    if result is None:
+        raise RuntimeError(f"{_ENGINE_LABELS.get(_AI_ENGINE, _AI_ENGINE)} 调用失败")
+
+    out, engine_used, data = result
+
+    # Extract the reply from the JSON envelope parsed by _run_engine; fall
+    # back to the raw output if it wasn't JSON or lacks the expected key.
+    text = _MISSING
+    if isinstance(data, dict):
+        try:
+            if engine_used == 'claude':
+                text = data.get('result', _MISSING)
+                if not _detected_model_name and 'modelUsage' in data:
+                    models = data['modelUsage']
+                    primary, _usage = max(models.items(), key=lambda kv: kv[1].get('costUSD', 0))
+                    _detected_model_name = _CLAUDE_MODEL_DISPLAY.get(primary, primary)
+            elif engine_used == 'gemini':
+                text = data.get('response', _MISSING)
+                if not _detected_model_name and 'stats' in data:
+                    model_stats = data['stats'].get('models', {})
+                    if model_stats:
+                        model_id = next(iter(model_stats))
+                        pretty = model_id.replace('gemini-', 'Gemini ').replace('-', ' ').title()
+                        _detected_model_name = pretty
+            elif engine_used == 'qwen':
+                text = data.get('result', _MISSING)
+        except (KeyError, StopIteration):
+            pass
+    if text is _MISSING:
+        text = out.decode('utf-8', errors='replace').strip()
+
+    if not text:
+        raise RuntimeError(f"{_ENGINE_LABELS.get(engine_used, engine_used)} 返回空内容")
 
-    return (raw, engine)
+    return text
 
 
 def _call_ai_cli(prompt):
@@ -359,86 +843,67 @@ def _call_ai_cli(prompt):
     Gemini: uses -m pro (latest Pro), --output-format json.
     Qwen:   uses CLI default (qwen3-coder), plain text output.
 
-    If Gemini/Qwen fails and Claude CLI is available, automatically falls back
-    to Claude so the analysis can continue.
+    If the active engine fails, every other installed engine is started
+    concurrently and the first valid response wins, so the analysis can
+    continue.
 
     Returns:
         str: The AI response text (stdout).
     Raises:
         RuntimeError: If no AI engine is available or all engines fail.
     """
-    global _detected_model_name, _AI_ENGINE
-
     if _AI_ENGINE is None:
-        raise RuntimeError(
-            "未检测到可用的 AI 引擎。请安装以下任一工具：\n"
-            "  1. Claude CLI: https://docs.anthropic.com/en/docs/claude-code\n"
-            "  2. Gemini CLI: npm install -g @google/gemini-cli\n"
-            "     （只需 Google 账号登录，免费使用）\n"
-            "  3. Qwen Code:  npm install -g @qwen-code/qwen-code\n"
-            "     （只需 qwen.ai 账号登录，免费使用）"
-        )
+        raise RuntimeError(_NO_ENGINE_ERROR)
 
     engine = _AI_ENGINE
+    # Encode once; the same bytes are fed to every engine attempted.
+    prompt = prompt.encode('utf-8')
     result = _run_engine(engine, prompt)
 
-    # Fallback chain: try other available engines if the primary one fails.
-    # Priority order: claude → gemini → qwen
+    # Fallback: run all other installed engines concurrently and take the
+    # first valid response, so the worst case is one timeout, not the sum.
     if result is None:
-        _all_engines = ['claude', 'gemini', 'qwen']
-        for fallback in _all_engines:
-            if fallback == engine:
-                continue  # skip the engine that already failed
-            cmd_name = 'qwen' if fallback == 'qwen' else fallback
-            if not shutil.which(cmd_name):
-                continue  # not installed
-            fallback_label = _ENGINE_LABELS.get(fallback, fallback)
-            _print_progress_safe(f"  {S.info(f'自动切换到 {fallback_label} 继续分析...')}")
-            if fallback == 'gemini':
-                _ensure_gemini_preview()
-            _AI_ENGINE = fallback
-            _detected_model_name = None
-            # Reset progress display for the new engine
-            _progress_state['engine_label'] = _ENGINE_LABELS.get(fallback, fallback)
-            _progress_state['start_time'] = time.monotonic()
-            result = _run_engine(fallback, prompt)
-            if result is not None:
-                break  # success
+        fallbacks = _begin_fallback(engine)
+        if fallbacks:
+            result = _race_engines(fallbacks, prompt)
+            _adopt_fallback(result)
 
-    if result is None:
-        raise RuntimeError(f"{_ENGINE_LABELS.get(_AI_ENGINE, _AI_ENGINE)} 调用失败")
+    return _response_text(result)
 
-    raw, engine_used = result
 
-    # Parse output — Claude and Gemini use JSON; Qwen uses plain text
-    text = raw
-    try:
-        if engine_used == 'claude':
-            data = json.loads(raw)
-            text = data.get('result', raw)
-            if not _detected_model_name and 'modelUsage' in data:
-                models = data['modelUsage']
-                primary = max(models, key=lambda m: models[m].get('costUSD', 0))
-                _detected_model_name = _CLAUDE_MODEL_DISPLAY.get(primary, primary)
-        elif engine_used == 'gemini':
-            data = json.loads(raw)
-            text = data.get('response', raw)
-            if not _detected_model_name and 'stats' in data:
-                model_stats = data['stats'].get('models', {})
-                if model_stats:
-                    model_id = next(iter(model_stats))
-                    pretty = model_id.replace('gemini-', 'Gemini ').replace('-', ' ').title()
-                    _detected_model_name = pretty
-        elif engine_used == 'qwen':
-            data = json.loads(raw)
-            text = data.get('result', raw)
-    except (json.JSONDecodeError, KeyError, StopIteration):
-        pass
+# ---------------------------------------------------------------------------
+# Prompt templates
+# The *_PROMPT_TEMPLATE strings are str.format templates (also used that way
+# by web_app). For calls made here they are pre-split once at import into
+# (literal, field, format_spec) segments, so rendering is a single join.
+# ---------------------------------------------------------------------------
 
-    if not text:
-        raise RuntimeError(f"{_ENGINE_LABELS.get(engine_used, engine_used)} 返回空内容")
+def _compile_template(template):
+    """Pre-split a str.format template into (literal, field, spec) segments.
 
-    return text
+    Adjacent literal-only pieces (produced around ``{{`` / ``}}`` escapes)
+    are merged, so the result alternates literal text and fields.
+    """
+    segments = []
+    pending = ''
+    for literal, field, spec, _conv in string.Formatter().parse(template):
+        pending += literal
+        if field is not None:
+            segments.append((pending, field, spec or ''))
+            pending = ''
+    if pending:
+        segments.append((pending, None, ''))
+    return tuple(segments)
+
+
+def _render_template(segments, **kwargs):
+    """Render segments from _compile_template — equivalent to template.format(**kwargs)."""
+    parts = []
+    for literal, field, spec in segments:
+        parts.append(literal)
+        if field is not None:
+            parts.append(format(kwargs[field], spec))
+    return ''.join(parts)
 
 
 ANALYSIS_PROMPT_TEMPLATE = """你是一位资深的股权研究分析师和DCF估值专家。请根据以下历史财务数据和公开市场信息，为 {company_name} ({ticker}) 生成DCF估值参数建议。
@@ -618,20 +1083,37 @@ Please conduct **independent, in-depth** analysis for each parameter below. Each
 
 **Note: JSON must be valid format, all strings in double quotes, no comments. Cite data sources in reasoning where applicable.**"""
 
+_ANALYSIS_SEGMENTS = _compile_template(ANALYSIS_PROMPT_TEMPLATE)
+_ANALYSIS_SEGMENTS_EN = _compile_template(ANALYSIS_PROMPT_TEMPLATE_EN)
 
-def analyze_company(ticker, summary_df, base_year_data, company_profile, calculated_wacc, calculated_tax_rate, base_year, ttm_quarter='', ttm_end_date=''):
-    """
-    Call AI CLI (Claude or Gemini) to analyze a company and generate DCF valuation parameters.
 
-    Returns:
-        dict with keys: parameters (dict), raw_text (str)
+# (weakref to the last summary_df, its to_string() text)
+_summary_table_cache = (None, '')
+
+
+def _summary_table(summary_df):
+    """summary_df.to_string(), reused while the same DataFrame is passed in.
+
+    The company analysis and the valuation-gap analysis both embed the
+    historical table in their prompts. summary_df is built once per run and
+    not modified afterwards, so the text is kept against a weak reference.
     """
+    global _summary_table_cache
+    ref, text = _summary_table_cache
+    if ref is None or ref() is not summary_df:
+        text = summary_df.to_string()
+        _summary_table_cache = (weakref.ref(summary_df), text)
+    return text
+
+
+def _build_analysis_prompt(ticker, summary_df, company_profile, calculated_wacc, calculated_tax_rate, base_year, ttm_quarter, ttm_end_date):
+    """Render the analysis prompt. Returns (prompt, company_name)."""
     company_name = company_profile.get('companyName', ticker)
     country = company_profile.get('country', 'United States')
     beta = company_profile.get('beta', 1.0)
     market_cap = company_profile.get('marketCap', 0)
 
-    financial_table = summary_df.to_string()
+    financial_table = _summary_table(summary_df)
 
     # Calculate forecast_year_1 using the same logic as main.py
     if ttm_end_date and ttm_quarter:
@@ -662,7 +1144,8 @@ def analyze_company(ticker, summary_df, base_year_data, company_profile, calcula
     search_year = forecast_year_1
     search_year_2 = forecast_year_1 + 1
 
-    prompt = ANALYSIS_PROMPT_TEMPLATE.format(
+    prompt = _render_template(
+        _ANALYSIS_SEGMENTS,
         ticker=ticker,
         company_name=company_name,
         country=country,
@@ -678,13 +1161,10 @@ def analyze_company(ticker, summary_df, base_year_data, company_profile, calcula
         ttm_context=ttm_context,
         ttm_base_label=ttm_base_label,
     )
+    return prompt, company_name
 
-    engine_name = _ai_engine_display_name()
-    print(f"\n{S.ai_label(f'正在使用 AI 分析 {company_name} ({ticker})...')}  {S.muted(f'({engine_name})')}")
-
-    with _with_progress(engine_name):
-        all_text = _call_ai_cli(prompt)
 
+def _analysis_result(all_text, engine_name):
     # Show actual model name if detected during the call
     if _detected_model_name and _detected_model_name != engine_name:
         print(S.muted(f"  模型: {_detected_model_name}"))
@@ -697,36 +1177,96 @@ def analyze_company(ticker, summary_df, base_year_data, company_profile, calcula
     }
 
 
+def analyze_company(ticker, summary_df, base_year_data, company_profile, calculated_wacc, calculated_tax_rate, base_year, ttm_quarter='', ttm_end_date=''):
+    """
+    Call AI CLI (Claude or Gemini) to analyze a company and generate DCF valuation parameters.
+
+    Returns:
+        dict with keys: parameters (dict), raw_text (str)
+    """
+    prompt, company_name = _build_analysis_prompt(
+        ticker, summary_df, company_profile, calculated_wacc, calculated_tax_rate,
+        base_year, ttm_quarter, ttm_end_date)
+
+    engine_name = _ai_engine_display_name()
+    print(f"\n{S.ai_label(f'正在使用 AI 分析 {company_name} ({ticker})...')}  {S.muted(f'({engine_name})')}")
+
+    with _with_progress(engine_name):
+        all_text = _call_ai_cli(prompt)
+
+    return _analysis_result(all_text, engine_name)
+
+
+_RE_JSON_BLOCK = re.compile(r'```json\s*\n?(.*?)\n?\s*```', re.DOTALL)
+# A JSON string literal (kept as is) or a trailing comma before } / ]
+_RE_TRAILING_COMMA = re.compile(r'("(?:[^"\\]|\\.)*")|,\s*([}\]])')
+_JSON_DECODER = json.JSONDecoder()
+
+
 def _parse_structured_parameters(text):
     """Parse structured JSON with value+reasoning per parameter."""
     # Try ```json ... ``` block
-    json_match = re.search(r'```json\s*\n?(.*?)\n?\s*```', text, re.DOTALL)
+    json_match = _RE_JSON_BLOCK.search(text)
     if json_match:
+        candidate = json_match.group(1)
         try:
-            return json.loads(json_match.group(1))
+            return _json_loads(candidate)
         except json.JSONDecodeError:
             pass
+        # Most common AI slip: a trailing comma before } or ]. Repair the
+        # fenced block first rather than re-scanning the whole response;
+        # string values are matched whole so a ",]" inside one survives.
+        repaired = _RE_TRAILING_COMMA.sub(lambda m: m.group(1) or m.group(2), candidate)
+        if repaired != candidate:
+            try:
+                return _json_loads(repaired)
+            except json.JSONDecodeError:
+                pass
 
-    # Try to find a large JSON object
-    json_match = re.search(r'\{[\s\S]*"revenue_growth_1"[\s\S]*"ronic_match_wacc"[\s\S]*\}', text)
-    if json_match:
-        # Find the balanced braces
-        raw = json_match.group(0)
-        depth = 0
-        for i, c in enumerate(raw):
-            if c == '{':
-                depth += 1
-            elif c == '}':
-                depth -= 1
-                if depth == 0:
-                    try:
-                        return json.loads(raw[:i+1])
-                    except json.JSONDecodeError:
-                        break
+    # Fall back to the first well-formed object holding the parameters.
+    # raw_decode() does the brace matching in C and reports where the
+    # object ends, so each candidate '{' costs one C-level parse.
+    key_pos = text.find('"revenue_growth_1"')
+    if key_pos == -1 or '"ronic_match_wacc"' not in text:
+        return None
+    start = text.find('{')
+    while start != -1 and start < key_pos:
+        try:
+            obj = _JSON_DECODER.raw_decode(text, start)[0]
+        except json.JSONDecodeError:
+            pass
+        else:
+            if isinstance(obj, dict) and 'revenue_growth_1' in obj:
+                return obj
+        start = text.find('{', start + 1)
 
     return None
 
 
+class _TerminalBuffer(io.StringIO):
+    """StringIO that reports whether the stream it stands in for is a terminal,
+    so output batched for the terminal is still rendered as such."""
+
+    def __init__(self, stream):
+        super().__init__()
+        self._stream = stream
+
+    def isatty(self):
+        return hasattr(self._stream, 'isatty') and self._stream.isatty()
+
+
+@contextmanager
+def _batched_output():
+    """Collect everything printed inside the block (including by helpers such
+    as _format_ai_text) and emit it to the terminal in a single write."""
+    buf = _TerminalBuffer(sys.stdout)
+    try:
+        with redirect_stdout(buf):
+            yield
+    finally:
+        sys.stdout.write(buf.getvalue())
+
+
 def interactive_review(ai_result, calculated_wacc, calculated_tax_rate, company_profile, wacc_details):
     """
     Interactive review of AI-suggested parameters.
@@ -773,29 +1313,30 @@ def interactive_review(ai_result, calculated_wacc, calculated_tax_rate, company_
             ai_value = param_data
             reasoning = ""
 
-        print(f"\n{S.subheader(label)}")
+        with _batched_output():
+            print(f"\n{S.subheader(label)}")
 
-        # Show AI reasoning for THIS parameter only
-        if reasoning:
-            print(f"\n  {S.ai_label('AI 分析:')}")
-            _format_ai_text(reasoning)
+            # Show AI reasoning for THIS parameter only
+            if reasoning:
+                print(f"\n  {S.ai_label('AI 分析:')}")
+                _format_ai_text(reasoning)
 
-        # For WACC: show the model calculation details
-        if key == "wacc" and wacc_details:
-            from .dcf import print_wacc_details
-            print_wacc_details(wacc_details)
+            # For WACC: show the model calculation details
+            if key == "wacc" and wacc_details:
+                print_wacc_details(wacc_details)
 
-        # For tax_rate: show calculated reference
-        if key == "tax_rate":
-            print(f"\n  {S.muted(f'历史平均有效税率: {calculated_tax_rate * 100:.1f}%')}")
+            # For tax_rate: show calculated reference
+            if key == "tax_rate":
+                print(f"\n  {S.muted(f'历史平均有效税率: {calculated_tax_rate * 100:.1f}%')}")
 
-        if ai_value is not None:
-            print(f"\n  {S.label('AI 建议值:')} {S.value(f'{ai_value}{unit}')}")
-            _warn_if_out_of_range(key, ai_value)
-            user_input = input(f"  {S.prompt(f'输入新值或按 Enter 接受 [{ai_value}]: ')}").strip()
-        else:
-            print(f"\n  {S.warning('AI 未提供建议值')}")
-            user_input = input(f"  {S.prompt('请输入值: ')}").strip()
+            if ai_value is not None:
+                print(f"\n  {S.label('AI 建议值:')} {S.value(f'{ai_value}{unit}')}")
+                _warn_if_out_of_range(key, ai_value)
+                input_prompt = f"  {S.prompt(f'输入新值或按 Enter 接受 [{ai_value}]: ')}"
+            else:
+                print(f"\n  {S.warning('AI 未提供建议值')}")
+                input_prompt = f"  {S.prompt('请输入值: ')}"
+        user_input = input(input_prompt).strip()
 
         if user_input == "":
             final_params[key] = float(ai_value) if ai_value is not None else 0.0
@@ -815,16 +1356,17 @@ def interactive_review(ai_result, calculated_wacc, calculated_tax_rate, company_
         ronic_match = ronic_data if isinstance(ronic_data, bool) else True
         ronic_reasoning = ""
 
-    print(f"\n{S.subheader('RONIC (终值期再投资收益率)')}")
+    with _batched_output():
+        print(f"\n{S.subheader('RONIC (终值期再投资收益率)')}")
 
-    if ronic_reasoning:
-        print(f"\n  {S.ai_label('AI 分析:')}")
-        _format_ai_text(ronic_reasoning)
+        if ronic_reasoning:
+            print(f"\n  {S.ai_label('AI 分析:')}")
+            _format_ai_text(ronic_reasoning)
 
-    if ronic_match:
-        print(f"\n  {S.label('AI 建议:')} {S.value('ROIC 在终值期回归 WACC（保守假设）')}")
-    else:
-        print(f"\n  {S.label('AI 建议:')} {S.value('ROIC 在终值期高于 WACC（公司有持续竞争优势）')}")
+        if ronic_match:
+            print(f"\n  {S.label('AI 建议:')} {S.value('ROIC 在终值期回归 WACC（保守假设）')}")
+        else:
+            print(f"\n  {S.label('AI 建议:')} {S.value('ROIC 在终值期高于 WACC（公司有持续竞争优势）')}")
 
     default_ronic = 'y' if ronic_match else 'n'
     ronic_input = input(f"  {S.prompt(f'ROIC 是否在终值期回归 WACC? (y/n) [{default_ronic}]: ')}").strip().lower()
@@ -995,18 +1537,114 @@ On the very last line of your analysis, output strictly in this format (number o
 
 Output analysis content directly, no JSON format needed (only the final ADJUSTED_PRICE line requires strict format)."""
 
+_GAP_SEGMENTS = _compile_template(GAP_ANALYSIS_PROMPT_TEMPLATE)
+_GAP_SEGMENTS_EN = _compile_template(GAP_ANALYSIS_PROMPT_TEMPLATE_EN)
 
-def analyze_valuation_gap(ticker, company_profile, results, valuation_params, summary_df, base_year, forecast_year_1=None, forex_rate=None):
+_RE_ADJ_PRICE = re.compile(r'ADJUSTED_PRICE:\s*([\d.,]+)')
+
+
+def _split_adjusted_price(text):
+    """Split the ``ADJUSTED_PRICE: <n>`` line off a gap-analysis reply.
+
+    The prompt asks for it as the last line, so the reply is searched from
+    the end and only that one line is parsed. Returns (display_text,
+    adjusted_price); adjusted_price is None if the line is missing or
+    unparsable.
+
+    This is the only place the marker is stripped: the terminal and web
+    displays, the Excel export and the history viewer all go through it,
+    so they show the same text.
     """
-    Call AI CLI (Claude or Gemini) to analyze the gap between DCF valuation and current stock price.
+    pos = text.rfind('ADJUSTED_PRICE:')
+    if pos == -1:
+        return text.strip(), None
+    line_start = text.rfind('\n', 0, pos) + 1
+    line_end = text.find('\n', pos)
+    if line_end == -1:
+        line_end = len(text)
+
+    adjusted_price = None
+    price_match = _RE_ADJ_PRICE.match(text, pos, line_end)
+    if price_match:
+        try:
+            adjusted_price = float(price_match.group(1).replace(',', ''))
+        except ValueError:
+            pass
+    return (text[:line_start] + text[line_end:]).strip(), adjusted_price
+
+
+# Gap-analysis responses are cached on disk, keyed on a hash of the engine
+# and the full prompt. The prompt already carries the ticker, prices, DCF
+# parameters and today's date, so any change to those misses the cache.
+_GAP_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.cache', 'ai_gap')
+_GAP_CACHE_TTL = 7 * 24 * 3600  # seconds
+_gap_cache_mode = 'on'          # 'on' | 'off' | 'refresh'
+_RE_UNSAFE_FILENAME = re.compile(r'[^\w.-]')
+
+
+def set_gap_cache(mode):
+    """Set how analyze_valuation_gap uses its disk cache (--no-cache / --refresh-cache).
 
     Args:
-        forex_rate: Exchange rate from reporting currency to stock trading currency.
-                    Required when they differ (e.g. CNY→HKD for HK-listed Chinese companies).
-                    If None and currencies match, no conversion is needed.
+        mode: 'on' (read and write), 'off' (neither), or 'refresh'
+              (ignore existing entries but store the new response)
+    """
+    global _gap_cache_mode
+    if mode not in ('on', 'off', 'refresh'):
+        raise ValueError(f"未知的缓存模式: {mode}")
+    _gap_cache_mode = mode
 
-    Returns:
-        dict with 'analysis_text' (str) and 'adjusted_price' (float or None), or None on failure.
+
+def _gap_cache_path(ticker, prompt):
+    key = hashlib.sha256(f"{_AI_ENGINE}\0{prompt}".encode('utf-8')).hexdigest()
+    safe_ticker = _RE_UNSAFE_FILENAME.sub('_', ticker)
+    return os.path.join(_GAP_CACHE_DIR, f"{safe_ticker}_{key[:16]}.json")
+
+
+def _gap_cache_load(path):
+    """Return the cached analysis text at *path*, or None if missing, stale or unreadable."""
+    if _gap_cache_mode != 'on':
+        return None
+    try:
+        if time.time() - os.path.getmtime(path) > _GAP_CACHE_TTL:
+            return None
+        with open(path, 'rb') as f:
+            entry = _json_loads(f.read())
+    except (OSError, ValueError):
+        return None
+    text = entry.get('analysis_text') if isinstance(entry, dict) else None
+    return text if isinstance(text, str) and text.strip() else None
+
+
+def _gap_cache_store(path, analysis_text):
+    """Write *analysis_text* to the cache. Failures are ignored — the cache is optional."""
+    if _gap_cache_mode == 'off':
+        return
+    entry = {
+        'engine': _AI_ENGINE,
+        'model': _detected_model_name,
+        'analysis_text': analysis_text,
+    }
+    tmp_path = None
+    try:
+        os.makedirs(_GAP_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=_GAP_CACHE_DIR)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _prepare_gap_analysis(ticker, company_profile, results, valuation_params, summary_df, base_year, forecast_year_1, forex_rate, announce=True):
+    """Build the gap-analysis prompt and print the price comparison header.
+
+    Shared by analyze_valuation_gap and prefetch_valuation_gap (which
+    passes announce=False to print nothing).
+    Returns a dict with the prompt and its cache path (both None when the
+    gap is below MIN_GAP_PCT) and the price / currency values needed to
+    present the reply, or None if there is no current price.
     """
     company_name = company_profile.get('companyName', ticker)
     country = company_profile.get('country', 'United States')
@@ -1016,7 +1654,8 @@ def analyze_valuation_gap(ticker, company_profile, results, valuation_params, su
     reported_currency = results.get('reported_currency', stock_currency)
 
     if current_price == 0:
-        print(f"\n{S.warning('无法获取当前股价，跳过估值差异分析。')}")
+        if announce:
+            print(f"\n{S.warning('无法获取当前股价，跳过估值差异分析。')}")
         return None
 
     # Convert DCF price to stock trading currency if they differ
@@ -1030,104 +1669,273 @@ def analyze_valuation_gap(ticker, company_profile, results, valuation_params, su
     gap_pct = (dcf_price - current_price) / current_price * 100
     gap_direction = 'DCF 估值高于市场价，市场可能低估' if gap_pct > 0 else 'DCF 估值低于市场价，市场可能高估'
 
-    # Build currency context for prompt
-    if currency_converted:
-        currency_note = (
-            f"\n\n**重要：货币换算说明**\n"
-            f"- 财务数据以 {reported_currency} 报告，DCF 原始估值为 {dcf_price_raw:.2f} {reported_currency}\n"
-            f"- 股票以 {stock_currency} 交易，已按汇率 {forex_rate:.4f} 换算为 {dcf_price:.2f} {stock_currency}\n"
-            f"- 以下所有价格比较和修正估值均以 {stock_currency} 为单位"
+    # Gaps below MIN_GAP_PCT are not sent to the AI, so no prompt is built
+    prompt = cache_path = None
+    if abs(gap_pct) >= MIN_GAP_PCT:
+        # Build currency context for prompt
+        if currency_converted:
+            currency_note = (
+                f"\n\n**重要：货币换算说明**\n"
+                f"- 财务数据以 {reported_currency} 报告，DCF 原始估值为 {dcf_price_raw:.2f} {reported_currency}\n"
+                f"- 股票以 {stock_currency} 交易，已按汇率 {forex_rate:.4f} 换算为 {dcf_price:.2f} {stock_currency}\n"
+                f"- 以下所有价格比较和修正估值均以 {stock_currency} 为单位"
+            )
+        else:
+            currency_note = ""
+
+        financial_table = _summary_table(summary_df)
+
+        today = date.today()
+        current_date_str = today.strftime('%Y-%m-%d')
+        current_year = today.year
+
+        prompt = _render_template(
+            _GAP_SEGMENTS,
+            company_name=company_name,
+            ticker=ticker,
+            country=country,
+            current_price=current_price,
+            currency=stock_currency,
+            dcf_price=dcf_price,
+            gap_pct=gap_pct,
+            gap_direction=gap_direction,
+            revenue_growth_1=valuation_params['revenue_growth_1'],
+            revenue_growth_2=valuation_params['revenue_growth_2'],
+            ebit_margin=valuation_params['ebit_margin'],
+            wacc=valuation_params['wacc'],
+            tax_rate=valuation_params['tax_rate'],
+            pv_cf=results['pv_cf_next_10_years'],
+            pv_terminal=results['pv_terminal_value'],
+            enterprise_value=results['enterprise_value'],
+            equity_value=results['equity_value'],
+            financial_table=financial_table,
+            forecast_year=forecast_year_1 if forecast_year_1 else base_year + 1,
+            current_date=current_date_str,
+            current_year=current_year,
         )
-    else:
-        currency_note = ""
+        if currency_note:
+            prompt += currency_note
+        cache_path = _gap_cache_path(ticker, prompt)
+
+    if announce:
+        print(f"\n{S.header('DCF 估值 vs 当前股价 差异分析')}")
+        if currency_converted:
+            print(f"  {S.label('当前股价:')}     {current_price:.2f} {stock_currency}")
+            print(f"  {S.label('DCF 估值:')}     {S.price_colored(dcf_price, current_price)} {stock_currency}  {S.muted(f'({dcf_price_raw:.2f} {reported_currency} × {forex_rate:.4f})')}")
+            print(f"  {S.label('差异:')}         {S.pct_colored(gap_pct)}")
+        else:
+            print(f"  {S.label('当前股价:')}     {current_price:.2f} {stock_currency}")
+            print(f"  {S.label('DCF 估值:')}     {S.price_colored(dcf_price, current_price)} {stock_currency}")
+            print(f"  {S.label('差异:')}         {S.pct_colored(gap_pct)}")
 
-    financial_table = summary_df.to_string()
+    return {
+        'prompt': prompt,
+        'cache_path': cache_path,
+        'current_price': current_price,
+        'dcf_price': dcf_price,
+        'dcf_price_raw': dcf_price_raw,
+        'gap_pct': gap_pct,
+        'stock_currency': stock_currency,
+        'reported_currency': reported_currency,
+        'currency_converted': currency_converted,
+        'forex_rate': forex_rate,
+    }
 
-    today = date.today()
-    current_date_str = today.strftime('%Y-%m-%d')
-    current_year = today.year
 
-    prompt = GAP_ANALYSIS_PROMPT_TEMPLATE.format(
-        company_name=company_name,
-        ticker=ticker,
-        country=country,
-        current_price=current_price,
-        currency=stock_currency,
-        dcf_price=dcf_price,
-        gap_pct=gap_pct,
-        gap_direction=gap_direction,
-        revenue_growth_1=valuation_params['revenue_growth_1'],
-        revenue_growth_2=valuation_params['revenue_growth_2'],
-        ebit_margin=valuation_params['ebit_margin'],
-        wacc=valuation_params['wacc'],
-        tax_rate=valuation_params['tax_rate'],
-        pv_cf=results['pv_cf_next_10_years'],
-        pv_terminal=results['pv_terminal_value'],
-        enterprise_value=results['enterprise_value'],
-        equity_value=results['equity_value'],
-        financial_table=financial_table,
-        forecast_year=forecast_year_1 if forecast_year_1 else base_year + 1,
-        current_date=current_date_str,
-        current_year=current_year,
-    )
-    if currency_note:
-        prompt += currency_note
-
-    print(f"\n{S.header('DCF 估值 vs 当前股价 差异分析')}")
-    if currency_converted:
-        print(f"  {S.label('当前股价:')}     {current_price:.2f} {stock_currency}")
-        print(f"  {S.label('DCF 估值:')}     {S.price_colored(dcf_price, current_price)} {stock_currency}  {S.muted(f'({dcf_price_raw:.2f} {reported_currency} × {forex_rate:.4f})')}")
-        print(f"  {S.label('差异:')}         {S.pct_colored(gap_pct)}")
-    else:
-        print(f"  {S.label('当前股价:')}     {current_price:.2f} {stock_currency}")
-        print(f"  {S.label('DCF 估值:')}     {S.price_colored(dcf_price, current_price)} {stock_currency}")
-        print(f"  {S.label('差异:')}         {S.pct_colored(gap_pct)}")
+def _small_gap_result(gap):
+    """Result for a gap below MIN_GAP_PCT: the AI is not called and the DCF
+    value stands as the adjusted price."""
+    gap_pct = gap['gap_pct']
+    currency_converted = gap['currency_converted']
+    print(f"\n{S.info(f'估值差异不显著（小于 {MIN_GAP_PCT:g}%），跳过 AI 差异分析。')}")
+    return {
+        'analysis_text': f"DCF 估值与当前股价差异为 {gap_pct:+.1f}%，低于 {MIN_GAP_PCT:g}% 阈值，未进行 AI 差异分析。",
+        'adjusted_price': gap['dcf_price'],
+        'adjusted_price_reporting': gap['dcf_price_raw'] if currency_converted else None,
+        'current_price': gap['current_price'],
+        'dcf_price': gap['dcf_price'],
+        'dcf_price_raw': gap['dcf_price_raw'] if currency_converted else None,
+        'gap_pct': gap_pct,
+        'currency': gap['stock_currency'],
+        'reported_currency': gap['reported_currency'] if currency_converted else None,
+        'forex_rate': gap['forex_rate'] if currency_converted else None,
+    }
 
-    try:
-        engine_name = _ai_engine_display_name()
-        print(f"\n{S.ai_label('正在使用 AI 分析估值差异原因...')}  {S.muted(f'({engine_name})')}")
 
-        with _with_progress(engine_name):
-            analysis_text = _call_ai_cli(prompt)
+def _cached_gap_text(gap):
+    """Return (cached_reply, None) on a cache hit, else (None, engine_name)
+    for the AI call about to be made; prints which of the two applies."""
+    analysis_text = _gap_cache_load(gap['cache_path'])
+    if analysis_text is not None:
+        print(f"\n{S.ai_label('使用缓存的 AI 差异分析结果')}  {S.muted('(--refresh-cache 可重新分析)')}")
+        return analysis_text, None
+    engine_name = _ai_engine_display_name()
+    print(f"\n{S.ai_label('正在使用 AI 分析估值差异原因...')}  {S.muted(f'({engine_name})')}")
+    return None, engine_name
 
-        # Parse adjusted price from the last line
-        adjusted_price = None
-        price_match = re.search(r'ADJUSTED_PRICE:\s*([\d.,]+)', analysis_text)
-        if price_match:
-            try:
-                adjusted_price = float(price_match.group(1).replace(',', ''))
-            except ValueError:
-                pass
 
-        # Compute adjusted price in reporting currency (reverse forex conversion)
-        adjusted_price_reporting = None
-        if adjusted_price is not None and currency_converted and forex_rate and forex_rate > 0:
-            adjusted_price_reporting = adjusted_price / forex_rate
+def _gap_result(gap, analysis_text):
+    """Parse and display the AI reply; return analyze_valuation_gap's result dict."""
+    current_price = gap['current_price']
+    stock_currency = gap['stock_currency']
+    reported_currency = gap['reported_currency']
+    currency_converted = gap['currency_converted']
+    forex_rate = gap['forex_rate']
+
+    # Parse adjusted price from the last line (and drop it from display)
+    display_text, adjusted_price = _split_adjusted_price(analysis_text)
+
+    # Compute adjusted price in reporting currency (reverse forex conversion)
+    adjusted_price_reporting = None
+    if adjusted_price is not None and currency_converted and forex_rate and forex_rate > 0:
+        adjusted_price_reporting = adjusted_price / forex_rate
+
+    print(f"\n{S.divider()}")
+    _format_ai_text(display_text, indent='  ')
+    print(S.divider())
+
+    if adjusted_price is not None:
+        adj_gap_pct = (adjusted_price - current_price) / current_price * 100
+        print(f"\n  {S.label('综合差异分析后修正估值:')} {S.price_colored(adjusted_price, current_price)} {stock_currency}（相对当前股价 {S.pct_colored(adj_gap_pct)}）")
+        if adjusted_price_reporting is not None:
+            print(f"  {S.label('修正估值（列报币种）:')} {adjusted_price_reporting:,.2f} {reported_currency}  {S.muted(f'(÷ {forex_rate:.4f})')}")
+
+    return {
+        'analysis_text': analysis_text,
+        'adjusted_price': adjusted_price,
+        'adjusted_price_reporting': adjusted_price_reporting,
+        'current_price': current_price,
+        'dcf_price': gap['dcf_price'],
+        'dcf_price_raw': gap['dcf_price_raw'] if currency_converted else None,
+        'gap_pct': gap['gap_pct'],
+        'currency': stock_currency,
+        'reported_currency': reported_currency if currency_converted else None,
+        'forex_rate': forex_rate if currency_converted else None,
+    }
 
-        # Display analysis (strip the ADJUSTED_PRICE line from display)
-        display_text = re.sub(r'\n?\s*ADJUSTED_PRICE:.*$', '', analysis_text).strip()
-        print(f"\n{S.divider()}")
-        _format_ai_text(display_text, indent='  ')
-        print(S.divider())
 
-        if adjusted_price is not None:
-            adj_gap_pct = (adjusted_price - current_price) / current_price * 100
-            print(f"\n  {S.label('综合差异分析后修正估值:')} {S.price_colored(adjusted_price, current_price)} {stock_currency}（相对当前股价 {S.pct_colored(adj_gap_pct)}）")
-            if adjusted_price_reporting is not None:
-                print(f"  {S.label('修正估值（列报币种）:')} {adjusted_price_reporting:,.2f} {reported_currency}  {S.muted(f'(÷ {forex_rate:.4f})')}")
-
-        return {
-            'analysis_text': analysis_text,
-            'adjusted_price': adjusted_price,
-            'adjusted_price_reporting': adjusted_price_reporting,
-            'current_price': current_price,
-            'dcf_price': dcf_price,
-            'dcf_price_raw': dcf_price_raw if currency_converted else None,
-            'gap_pct': gap_pct,
-            'currency': stock_currency,
-            'reported_currency': reported_currency if currency_converted else None,
-            'forex_rate': forex_rate if currency_converted else None,
-        }
+# Speculative gap analysis started by prefetch_valuation_gap while the user
+# reviews parameters: (cache_path, _EngineRace, Future, messages) or None,
+# where messages collects the background run's engine errors.
+_gap_prefetch = None
+
+
+def prefetch_valuation_gap(ticker, company_profile, results, valuation_params, summary_df, base_year, forecast_year_1=None, forex_rate=None):
+    """Start the gap analysis for a draft valuation in the background.
+
+    main.py calls this (only with --prefetch-gap, since the AI call is wasted
+    if the user edits a parameter or declines the gap analysis) with the
+    AI-suggested parameters just before interactive_review, so the AI call
+    overlaps with the user's review. If the reviewed valuation yields the
+    same prompt, analyze_valuation_gap uses this reply; otherwise the run is
+    killed. The background thread neither prints nor draws the spinner, and
+    runs only the active engine (no fallback) — a failed prefetch is
+    reported when analyze_valuation_gap picks it up and calls the AI itself.
+    """
+    global _gap_prefetch
+    cancel_gap_prefetch()
+    if _AI_ENGINE is None:
+        return
+    gap = _prepare_gap_analysis(ticker, company_profile, results, valuation_params,
+                                summary_df, base_year, forecast_year_1, forex_rate,
+                                announce=False)
+    if (gap is None or gap['prompt'] is None
+            or _gap_cache_load(gap['cache_path']) is not None):
+        return
+
+    engine = _AI_ENGINE
+    prompt = gap['prompt'].encode('utf-8')
+    race = _EngineRace()
+    future = Future()
+    messages = []
+
+    def _worker():
+        _thread_flags.quiet = True
+        _thread_flags.no_spinner = True
+        _thread_flags.log = messages
+        try:
+            future.set_result(_run_engine(engine, prompt, race))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=_worker, daemon=True).start()
+    _gap_prefetch = (gap['cache_path'], race, future, messages)
+
+
+def cancel_gap_prefetch():
+    """Kill a pending prefetch_valuation_gap run (e.g. the user skipped the gap analysis)."""
+    global _gap_prefetch
+    if _gap_prefetch is not None:
+        _gap_prefetch[1].cancel()
+        _gap_prefetch = None
+
+
+atexit.register(cancel_gap_prefetch)
+
+
+def _prefetched_gap_text(cache_path):
+    """Wait for a prefetched reply to *cache_path*'s prompt and return its
+    text, or None if there is none (a prefetch for another prompt is killed)."""
+    global _gap_prefetch
+    if _gap_prefetch is None:
+        return None
+    path, race, future, messages = _gap_prefetch
+    if path != cache_path:
+        cancel_gap_prefetch()
+        return None
+    _gap_prefetch = None
+    # Keep the spinner turning while the background run finishes
+    error = None
+    while True:
+        try:
+            result = future.result(timeout=_progress_tick() or _POLL_INTERVAL)
+            break
+        except FutureTimeoutError:
+            pass
+        except Exception as e:
+            result, error = None, e
+            break
+    if result is not None:
+        try:
+            return _response_text(result)
+        except RuntimeError as e:
+            error = e
+    for msg in messages:
+        _print_progress_safe(msg)
+    if error is not None:
+        _print_progress_safe(f"  {S.warning(f'后台差异分析失败: {error}')}")
+    _print_progress_safe(f"  {S.muted('后台预取未得到结果，重新调用 AI...')}")
+    return None
+
+
+def analyze_valuation_gap(ticker, company_profile, results, valuation_params, summary_df, base_year, forecast_year_1=None, forex_rate=None):
+    """
+    Call AI CLI (Claude or Gemini) to analyze the gap between DCF valuation and current stock price.
+
+    Args:
+        forex_rate: Exchange rate from reporting currency to stock trading currency.
+                    Required when they differ (e.g. CNY→HKD for HK-listed Chinese companies).
+                    If None and currencies match, no conversion is needed.
+
+    Returns:
+        dict with 'analysis_text' (str) and 'adjusted_price' (float or None), or None on failure.
+    """
+    gap = _prepare_gap_analysis(ticker, company_profile, results, valuation_params,
+                                summary_df, base_year, forecast_year_1, forex_rate)
+    if gap is None:
+        return None
+    if gap['prompt'] is None:
+        return _small_gap_result(gap)
+
+    try:
+        analysis_text, engine_name = _cached_gap_text(gap)
+        if analysis_text is None:
+            with _with_progress(engine_name):
+                analysis_text = _prefetched_gap_text(gap['cache_path'])
+                if analysis_text is None:
+                    analysis_text = _call_ai_cli(gap['prompt'])
+            _gap_cache_store(gap['cache_path'], analysis_text)
+        return _gap_result(gap, analysis_text)
 
     except subprocess.TimeoutExpired:
         print(f"\n{S.warning('AI 分析超时，跳过差异分析。')}")
@@ -1137,19 +1945,81 @@ def analyze_valuation_gap(ticker, company_profile, results, valuation_params, su
         return None
 
 
+# Markdown / terminal patterns used by the text formatter below
+_RE_ANSI = re.compile(r'\033\[[0-9;]*m')
+_RE_BOLD = re.compile(r'\*\*(.+?)\*\*')
+_RE_HEADER = re.compile(r'^(#{1,4})\s+(.*)')
+_RE_NUM_ITEM = re.compile(r'^(\s*)(\d+\.\s+)(.*)')
+_RE_BULLET_ITEM = re.compile(r'^(\s*)([-*]\s+)(.*)')
+_RE_DIVIDER = re.compile(r'^[-=]{3,}\s*$')
+_RE_TABLE_SEP = re.compile(r'^[\s:|-]+$')
+
+# East Asian Wide / Fullwidth characters take two terminal columns. Planes
+# 2-3 (CJK extensions) are wide throughout; planes 0-1 use a table built on
+# first use that maps each wide code point to a two-column placeholder, so
+# len(s.translate(table)) is the display width in one C-level pass.
+_WIDE_EXT_START, _WIDE_EXT_END = 0x20000, 0x3FFFF
+_RE_WIDE_EXT = re.compile('[\U00020000-\U0003FFFF]')
+
+
+@functools.lru_cache(maxsize=None)
+def _wide_table():
+    eaw = unicodedata.east_asian_width
+    return {c: '  ' for c in range(_WIDE_EXT_START) if eaw(chr(c)) in ('F', 'W')}
+
+
+@functools.lru_cache(maxsize=None)
+def _width_array():
+    """Per-code-point column widths (uint8) for planes 0-3, plus a final
+    width-1 slot that every higher code point is clamped to."""
+    widths = np.ones(_WIDE_EXT_END + 2, dtype=np.uint8)
+    widths[np.fromiter(_wide_table(), dtype=np.int64)] = 2
+    widths[_WIDE_EXT_START:_WIDE_EXT_END + 1] = 2
+    return widths
+
+
+def _wrap_to_width(text, max_w):
+    """Split *text* into pieces of at most *max_w* display columns.
+
+    Breaks fall between characters (CJK text has no word boundaries); a
+    space landing at a break is dropped. Break points come from a cumsum of
+    per-character widths and searchsorted, so only the per-line bookkeeping
+    runs in Python.
+    """
+    codes = np.frombuffer(text.encode('utf-32-le', 'surrogatepass'), dtype='<u4')
+    table = _width_array()
+    cum = np.cumsum(table[np.minimum(codes, len(table) - 1)], dtype=np.int64)
+    n = len(text)
+    pieces = []
+    start = 0
+    while start < n:
+        base = int(cum[start - 1]) if start else 0
+        end = int(np.searchsorted(cum, base + max_w, side='right'))
+        if end <= start:
+            end = start + 1  # a single character wider than the line
+        pieces.append(text[start:end])
+        if end < n and text[end] == ' ':
+            end += 1  # skip leading space on new line
+        start = end
+    return pieces
+
+
 def _display_width(s):
     """Return the visual display width of *s* in a terminal.
 
     CJK / full-width characters count as 2 columns; all others as 1.
     ANSI escape sequences are excluded from the count.
     """
-    # Strip ANSI escape codes before measuring
-    plain = re.sub(r'\033\[[0-9;]*m', '', s)
-    w = 0
-    for ch in plain:
-        eaw = unicodedata.east_asian_width(ch)
-        w += 2 if eaw in ('F', 'W') else 1
-    return w
+    # Strip ANSI escape codes before measuring (AI text rarely has any, so
+    # only run the regex when an ESC is present)
+    plain = _RE_ANSI.sub('', s) if '\x1b' in s else s
+    if plain.isascii():
+        return len(plain)
+    return len(plain.translate(_wide_table())) + len(_RE_WIDE_EXT.findall(plain))
+
+
+# Reused across _wrap_line calls; width / indents are set per call.
+_ASCII_WRAPPER = textwrap.TextWrapper(break_on_hyphens=False)
 
 
 def _wrap_line(text, width, indent=''):
@@ -1166,53 +2036,51 @@ def _wrap_line(text, width, indent=''):
     if avail < 20:
         avail = 20  # safety floor
 
-    result = []
-    buf = ''
-    buf_w = 0
-
-    for ch in text:
-        ch_w = 2 if unicodedata.east_asian_width(ch) in ('F', 'W') else 1
-        if buf_w + ch_w > avail:
-            result.append(f'{indent}{buf}')
-            buf = ''
-            buf_w = 0
-            if ch == ' ':
-                continue  # skip leading space on new line
-        buf += ch
-        buf_w += ch_w
+    # Pure-ASCII text is one column per character, so the stdlib wrapper
+    # (which also breaks at word boundaries) gives correct results.
+    if text.isascii():
+        _ASCII_WRAPPER.width = indent_w + avail
+        _ASCII_WRAPPER.initial_indent = indent
+        _ASCII_WRAPPER.subsequent_indent = indent
+        return _ASCII_WRAPPER.wrap(text) or [indent]
 
-    if buf:
-        result.append(f'{indent}{buf}')
-
-    return result or [indent]
+    return [f'{indent}{piece}' for piece in _wrap_to_width(text, avail)] or [indent]
 
 
 def _render_bold(text):
     """Convert markdown **bold** to ANSI bold."""
-    if not S._COLOR:
+    return _render_bold_cached(text, S._COLOR)
+
+
+# Keyed on the colour flag too, so toggling S._COLOR never serves stale output
+@functools.lru_cache(maxsize=4096)
+def _render_bold_cached(text, color):
+    if not color:
         return text.replace('**', '')
-    return re.sub(r'\*\*(.+?)\*\*', f'{S.BOLD}\\1{S.RESET}', text)
+    return _RE_BOLD.sub(f'{S.BOLD}\\1{S.RESET}', text)
 
 
-def _render_table(table_lines, indent='    '):
+def _render_table(table_lines, indent='    ', term_w=None):
     """Render markdown table lines as a box-drawn terminal table.
 
     Parses ``| col | col |`` rows, computes column widths using
     display-width-aware measurement, wraps long cell content, and
     outputs with box-drawing characters (─ │ ┌ ┐ └ ┘ ├ ┤ ┬ ┴ ┼).
+    *term_w* is the terminal width in columns (queried if not given).
+    Returns the rendered lines (empty if there were no data rows).
     """
     # Parse rows into cells, skipping separator lines (|---|---|)
     rows = []
     for line in table_lines:
         stripped = line.strip().strip('|')
-        if re.match(r'^[\s:|-]+$', stripped):
+        if _RE_TABLE_SEP.match(stripped):
             continue  # skip separator rows like |---|---|
         # Strip **bold** markers — bold is handled via header styling
         cells = [c.strip().replace('**', '') for c in stripped.split('|')]
         rows.append(cells)
 
     if not rows:
-        return
+        return []
 
     # Normalise column count
     n_cols = max(len(r) for r in rows)
@@ -1220,16 +2088,13 @@ def _render_table(table_lines, indent='    '):
         while len(r) < n_cols:
             r.append('')
 
-    # Compute natural column widths
-    nat_widths = [0] * n_cols
-    for r in rows:
-        for i, cell in enumerate(r):
-            w = _display_width(cell)
-            if w > nat_widths[i]:
-                nat_widths[i] = w
+    # Measure every cell once; reused for column sizing, wrapping and padding
+    cell_widths = [[_display_width(cell) for cell in r] for r in rows]
+    nat_widths = [max(col) for col in zip(*cell_widths)]
 
     # Fit table to terminal width — shrink columns if needed
-    term_w = shutil.get_terminal_size((80, 24)).columns
+    if term_w is None:
+        term_w = shutil.get_terminal_size((80, 24)).columns
     indent_w = _display_width(indent)
     # border overhead: indent + outer │ + per-column " cell │"
     border_overhead = indent_w + 1 + n_cols * 3
@@ -1260,30 +2125,24 @@ def _render_table(table_lines, indent='    '):
 
     # ── helpers ──
 
-    def _wrap_cell(text, max_w):
-        """Wrap cell text to fit within *max_w* display columns."""
-        if _display_width(text) <= max_w:
-            return [text]
-        lines = []
-        buf = ''
-        buf_w = 0
-        for ch in text:
-            ch_w = 2 if unicodedata.east_asian_width(ch) in ('F', 'W') else 1
-            if buf_w + ch_w > max_w:
-                lines.append(buf)
-                buf = ''
-                buf_w = 0
-                if ch == ' ':
-                    continue  # skip leading space on new line
-            buf += ch
-            buf_w += ch_w
-        if buf:
-            lines.append(buf)
-        return lines or ['']
-
-    def _pad(text, target_w):
+    def _wrap_cell(text, text_w, max_w):
+        """Wrap cell text (*text_w* columns wide) to fit within *max_w*
+        display columns. Returns (line, line_width) pairs."""
+        if text_w <= max_w:
+            return [(text, text_w)]
+        # Pure-ASCII cells wrap at word boundaries, as in _wrap_line
+        if text.isascii():
+            _ASCII_WRAPPER.width = max_w
+            _ASCII_WRAPPER.initial_indent = ''
+            _ASCII_WRAPPER.subsequent_indent = ''
+            lines = _ASCII_WRAPPER.wrap(text)
+        else:
+            lines = _wrap_to_width(text, max_w)
+        return [(ln, _display_width(ln)) for ln in lines] or [('', 0)]
+
+    def _pad(text, text_w, target_w):
         """Pad *text* to *target_w* display columns with trailing spaces."""
-        return text + ' ' * max(0, target_w - _display_width(text))
+        return text + ' ' * max(0, target_w - text_w)
 
     def _hline(left, mid, right):
         segs = ['─' * (w + 2) for w in col_widths]
@@ -1291,30 +2150,40 @@ def _render_table(table_lines, indent='    '):
 
     # ── render ──
 
-    print(_hline('┌', '┬', '┐'))
+    out = [_hline('┌', '┬', '┐')]
 
     for row_idx, cells in enumerate(rows):
         # Wrap each cell to its column width
-        wrapped = [_wrap_cell(cells[i], col_widths[i]) for i in range(n_cols)]
+        widths = cell_widths[row_idx]
+        wrapped = [_wrap_cell(cells[i], widths[i], col_widths[i]) for i in range(n_cols)]
         max_lines = max(len(w) for w in wrapped)
 
         for line_idx in range(max_lines):
             parts = []
             for i in range(n_cols):
-                cell_line = wrapped[i][line_idx] if line_idx < len(wrapped[i]) else ''
-                padded = _pad(cell_line, col_widths[i])
+                cell_line, line_w = wrapped[i][line_idx] if line_idx < len(wrapped[i]) else ('', 0)
+                padded = _pad(cell_line, line_w, col_widths[i])
                 # Bold styling for header row
                 if row_idx == 0 and S._COLOR:
                     padded = f'{S.BOLD}{padded}{S.RESET}'
                 parts.append(f' {padded} ')
-            print(f'{indent}│{"│".join(parts)}│')
+            out.append(f'{indent}│{"│".join(parts)}│')
 
-        # After header row, print a separator
+        # After header row, add a separator
         if row_idx == 0:
-            print(_hline('├', '┼', '┤'))
+            out.append(_hline('├', '┼', '┤'))
+
+    # Bottom border
+    out.append(_hline('└', '┴', '┘'))
+    return out
 
-    # Print bottom border
-    print(_hline('└', '┴', '┘'))
+
+def _render_markdown():
+    """Whether _format_ai_text should render for a terminal, decided per call
+    from the current stdout. When output is piped the raw markdown is written
+    instead; VALUX_FORCE_RENDER=1 keeps the terminal rendering."""
+    return (os.environ.get('VALUX_FORCE_RENDER') == '1'
+            or (hasattr(sys.stdout, 'isatty') and sys.stdout.isatty()))
 
 
 def _format_ai_text(text, indent='    ', width=None):
@@ -1327,36 +2196,52 @@ def _format_ai_text(text, indent='    ', width=None):
       - ``| tables |``  → box-drawn tables with aligned columns
       - long paragraphs → auto-wrapped at terminal width
       - blank lines     → kept as paragraph separators
+
+    When stdout is not a terminal the markdown is written through unchanged.
     """
+    if not _render_markdown():
+        sys.stdout.write(f"{text}\n")
+        return
+
+    # Query the terminal once per render; tables are fitted to it too
+    term_w = shutil.get_terminal_size((80, 24)).columns
     if width is None:
-        width = shutil.get_terminal_size((80, 24)).columns - 2  # small margin
+        width = term_w - 2  # small margin
     if width < 40:
         width = 40
 
     lines = text.split('\n')
     prev_blank = False
     table_buf = []  # accumulate consecutive table rows
+    # Rendered output lines, written to stdout in one go at the end
+    out = []
+    emit = out.append
 
     def _flush_table():
         """Render accumulated table rows and clear the buffer."""
         if table_buf:
-            _render_table(table_buf, indent=indent)
+            out.extend(_render_table(table_buf, indent=indent, term_w=term_w))
             table_buf.clear()
 
     for raw_line in lines:
         line = raw_line.rstrip()
+        stripped = line.lstrip()
 
         # --- blank line → paragraph break (max one) ---
-        if not line.strip():
+        if not stripped:
             _flush_table()
             if not prev_blank:
-                print()
+                emit('')
                 prev_blank = True
             continue
         prev_blank = False
 
+        # Each line type below is gated on its first non-space character,
+        # so ordinary paragraph lines are classified without any regex.
+        c0 = stripped[0]
+
         # --- table row (starts with |) → collect into buffer ---
-        if line.lstrip().startswith('|'):
+        if c0 == '|':
             table_buf.append(line)
             continue
 
@@ -1364,19 +2249,19 @@ def _format_ai_text(text, indent='    ', width=None):
         _flush_table()
 
         # --- markdown header ---
-        hdr_match = re.match(r'^(#{1,4})\s+(.*)', line)
+        hdr_match = _RE_HEADER.match(line) if c0 == '#' else None
         if hdr_match:
             title = hdr_match.group(2).strip()
             title = title.replace('**', '')  # strip bold markers in headers
-            print(f"\n{indent}{S.ai_label(title)}")
+            emit(f"\n{indent}{S.ai_label(title)}")
             continue
 
         # --- divider line (--- or ===) ---
-        if re.match(r'^[-=]{3,}\s*$', line.strip()):
+        if c0 in '-=' and _RE_DIVIDER.match(stripped):
             continue  # skip markdown horizontal rules
 
         # --- numbered list item (e.g. "1. xxx", "  2. xxx") ---
-        num_match = re.match(r'^(\s*)(\d+\.\s+)(.*)', line)
+        num_match = _RE_NUM_ITEM.match(line) if c0.isdigit() else None
         if num_match:
             pre_indent = num_match.group(1)
             marker = num_match.group(2)
@@ -1386,12 +2271,11 @@ def _format_ai_text(text, indent='    ', width=None):
             wrapped = _wrap_line(content, width, cont_indent)
             if wrapped:
                 wrapped[0] = first_indent + wrapped[0][len(cont_indent):]
-            for wl in wrapped:
-                print(wl)
+            out.extend(wrapped)
             continue
 
         # --- bullet list item (- or *) ---
-        bullet_match = re.match(r'^(\s*)([-*]\s+)(.*)', line)
+        bullet_match = _RE_BULLET_ITEM.match(line) if c0 in '-*' else None
         if bullet_match:
             pre_indent = bullet_match.group(1)
             marker = bullet_match.group(2)
@@ -1401,42 +2285,53 @@ def _format_ai_text(text, indent='    ', width=None):
             wrapped = _wrap_line(content, width, cont_indent)
             if wrapped:
                 wrapped[0] = first_indent + wrapped[0][len(cont_indent):]
-            for wl in wrapped:
-                print(wl)
+            out.extend(wrapped)
             continue
 
         # --- regular paragraph line ---
         content = _render_bold(line.strip())
-        for wl in _wrap_line(content, width, indent):
-            print(wl)
+        out.extend(_wrap_line(content, width, indent))
 
     # Flush any trailing table at end of text
     _flush_table()
 
+    if out:
+        out.append('')
+        sys.stdout.write('\n'.join(out))
+
+
+# Typical (low, high) bounds per parameter — values outside get a warning.
+_PARAM_RANGES = types.MappingProxyType({
+    "revenue_growth_1": (-50, 100),
+    "revenue_growth_2": (-20, 50),
+    "ebit_margin": (-20, 60),
+    "convergence": (1, 10),
+    "revenue_invested_capital_ratio_1": (0, 10),
+    "revenue_invested_capital_ratio_2": (0, 10),
+    "revenue_invested_capital_ratio_3": (0, 10),
+    "tax_rate": (0, 50),
+    "wacc": (3, 25),
+})
+
 
 def _warn_if_out_of_range(key, value):
     """Print a warning if a parameter value seems unreasonable."""
-    try:
-        v = float(value)
-    except (TypeError, ValueError):
+    bounds = _PARAM_RANGES.get(key)
+    if bounds is None:
         return
+    if isinstance(value, (int, float)):
+        v = value
+    else:
+        try:
+            v = float(value)
+        except (TypeError, ValueError):
+            return
+    if math.isnan(v):
+        return  # missing value, not an out-of-range one
 
-    ranges = {
-        "revenue_growth_1": (-50, 100),
-        "revenue_growth_2": (-20, 50),
-        "ebit_margin": (-20, 60),
-        "convergence": (1, 10),
-        "revenue_invested_capital_ratio_1": (0, 10),
-        "revenue_invested_capital_ratio_2": (0, 10),
-        "revenue_invested_capital_ratio_3": (0, 10),
-        "tax_rate": (0, 50),
-        "wacc": (3, 25),
-    }
-
-    if key in ranges:
-        low, high = ranges[key]
-        if v < low or v > high:
-            print(f"  {S.warning(f'⚠ 警告: 该值 ({v}) 超出通常范围 ({low} ~ {high})，请仔细确认')}")
+    low, high = bounds
+    if not (low <= v <= high):
+        print(f"  {S.warning(f'⚠ 警告: 该值 ({v}) 超出通常范围 ({low} ~ {high})，请仔细确认')}")
 
 
 # ---------------------------------------------------------------------------
@@ -1589,77 +2484,73 @@ def _format_search_results(queries, all_results, scraped_pages=None):
     return "\n\n".join(sections)
 
 
-def _build_cloud_analysis_prompt(template_args, search_context, lang='zh'):
-    """Build analysis prompt with search results injected (no WebSearch tool needed).
+def _splice_search_block(template, marker, end_markers, replacement):
+    """Replace the WebSearch instruction block of a prompt template.
 
-    Uses the same ANALYSIS_PROMPT_TEMPLATE but replaces the WebSearch instructions
-    with pre-fetched search results.
+    The block runs from *marker* up to the first of *end_markers* found
+    after it; *replacement* may contain a ``{search_context}`` field.
+    Returns *template* unchanged if the block can't be located.
     """
-    _template = ANALYSIS_PROMPT_TEMPLATE if lang == 'zh' else ANALYSIS_PROMPT_TEMPLATE_EN
-    prompt = _template.format(**template_args)
-
-    # Replace the WebSearch instructions block with search results
-    if lang == 'zh':
-        search_instruction_marker = "**重要：请务必先使用 WebSearch 工具搜索以下信息再开始分析：**"
-        replacement_header = "**以下是通过 Google 搜索获取的最新市场数据，请基于这些数据进行分析（你没有 WebSearch 工具，请直接使用下面的搜索结果）：**"
-    else:
-        search_instruction_marker = "**Important: You MUST use WebSearch to search for the following information before starting your analysis:**"
-        replacement_header = "**The following market data has been retrieved via Google Search. Analyze based on these results (you do NOT have WebSearch — use the search results below directly):**"
-
-    # Find and replace the search instructions block
-    marker_pos = prompt.find(search_instruction_marker)
-    if marker_pos >= 0:
-        # Find the end of the search instructions (before the next ## section)
-        next_section = prompt.find("\n## ", marker_pos + len(search_instruction_marker))
-        if next_section < 0:
-            # Try finding the --- separator
-            next_section = prompt.find("\n---", marker_pos + len(search_instruction_marker))
+    marker_pos = template.find(marker)
+    if marker_pos < 0:
+        return template
+    for end_marker in end_markers:
+        next_section = template.find(end_marker, marker_pos + len(marker))
         if next_section >= 0:
-            prompt = (
-                prompt[:marker_pos]
-                + replacement_header + "\n\n"
-                + search_context + "\n\n"
-                + prompt[next_section:]
-            )
+            return template[:marker_pos] + replacement + template[next_section:]
+    return template
+
+
+# Cloud variants of the prompts: the WebSearch instructions are swapped for
+# a {search_context} field once here, instead of rendering the full prompt
+# and splicing the search results in on every call.
+_CLOUD_ANALYSIS_SEGMENTS = {
+    'zh': _compile_template(_splice_search_block(
+        ANALYSIS_PROMPT_TEMPLATE,
+        "**重要：请务必先使用 WebSearch 工具搜索以下信息再开始分析：**",
+        ("\n## ", "\n---"),
+        "**以下是通过 Google 搜索获取的最新市场数据，请基于这些数据进行分析（你没有 WebSearch 工具，请直接使用下面的搜索结果）：**\n\n"
+        "{search_context}\n\n")),
+    'en': _compile_template(_splice_search_block(
+        ANALYSIS_PROMPT_TEMPLATE_EN,
+        "**Important: You MUST use WebSearch to search for the following information before starting your analysis:**",
+        ("\n## ", "\n---"),
+        "**The following market data has been retrieved via Google Search. Analyze based on these results (you do NOT have WebSearch — use the search results below directly):**\n\n"
+        "{search_context}\n\n")),
+}
 
-    return prompt
+_CLOUD_GAP_SEGMENTS = {
+    'zh': _compile_template(_splice_search_block(
+        GAP_ANALYSIS_PROMPT_TEMPLATE,
+        "**请使用 WebSearch 搜索以下信息来辅助分析",
+        ("\n请用**中文**进行分析",),
+        "**以下是通过 Google 搜索获取的最新市场数据，请基于这些数据进行分析"
+        "（你没有 WebSearch 工具，请直接使用下面的搜索结果）：**\n\n"
+        "{search_context}\n")),
+    'en': _compile_template(_splice_search_block(
+        GAP_ANALYSIS_PROMPT_TEMPLATE_EN,
+        "**Please use WebSearch to search for the following information",
+        ("\nPlease conduct your analysis in **English**",),
+        "**The following market data has been retrieved via Google Search. "
+        "Analyze based on these results (you do NOT have WebSearch):**\n\n"
+        "{search_context}\n")),
+}
 
 
-def _build_cloud_gap_prompt(template_args, search_context, lang='zh'):
-    """Build gap analysis prompt with search results injected."""
-    _template = GAP_ANALYSIS_PROMPT_TEMPLATE if lang == 'zh' else GAP_ANALYSIS_PROMPT_TEMPLATE_EN
-    prompt = _template.format(**template_args)
+def _build_cloud_analysis_prompt(template_args, search_context, lang='zh'):
+    """Build analysis prompt with search results injected (no WebSearch tool needed).
 
-    # Replace the WebSearch instructions block with search results
-    if lang == 'zh':
-        search_instruction_marker = "**请使用 WebSearch 搜索以下信息来辅助分析"
-    else:
-        search_instruction_marker = "**Please use WebSearch to search for the following information"
+    Uses the same ANALYSIS_PROMPT_TEMPLATE but with the WebSearch instructions
+    replaced by pre-fetched search results.
+    """
+    _segments = _CLOUD_ANALYSIS_SEGMENTS['zh' if lang == 'zh' else 'en']
+    return _render_template(_segments, search_context=search_context, **template_args)
 
-    marker_pos = prompt.find(search_instruction_marker)
-    if marker_pos >= 0:
-        # Find the end of the search instructions block (before the analysis instructions)
-        if lang == 'zh':
-            next_section_marker = "\n请用**中文**进行分析"
-        else:
-            next_section_marker = "\nPlease conduct your analysis in **English**"
-        next_section = prompt.find(next_section_marker, marker_pos)
-        if next_section >= 0:
-            if lang == 'zh':
-                replacement = (
-                    "**以下是通过 Google 搜索获取的最新市场数据，请基于这些数据进行分析"
-                    "（你没有 WebSearch 工具，请直接使用下面的搜索结果）：**\n\n"
-                    + search_context + "\n"
-                )
-            else:
-                replacement = (
-                    "**The following market data has been retrieved via Google Search. "
-                    "Analyze based on these results (you do NOT have WebSearch):**\n\n"
-                    + search_context + "\n"
-                )
-            prompt = prompt[:marker_pos] + replacement + prompt[next_section:]
-
-    return prompt
+
+def _build_cloud_gap_prompt(template_args, search_context, lang='zh'):
+    """Build gap analysis prompt with search results injected."""
+    _segments = _CLOUD_GAP_SEGMENTS['zh' if lang == 'zh' else 'en']
+    return _render_template(_segments, search_context=search_context, **template_args)
 
 
 def _collect_top_links(all_results, max_links=3):
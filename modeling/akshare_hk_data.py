@@ -13,6 +13,11 @@ Each report date has multiple rows (one per financial item).
 Quarterly data is cumulative (YTD), same as A-shares.
 """
 
+import functools
+import time
+import weakref
+
+import numpy as np
 import requests
 import pandas as pd
 
@@ -70,21 +75,11 @@ def _detect_hk_currency(stock):
     return 'HKD'
 
 
-def _safe(val):
-    """Convert to float, treating None/NaN as 0."""
-    if val is None:
-        return 0.0
-    try:
-        v = float(val)
-        return 0.0 if pd.isna(v) else v
-    except (ValueError, TypeError):
-        return 0.0
-
-
 # ---------------------------------------------------------------------------
 # Ticker conversion
 # ---------------------------------------------------------------------------
 
+@functools.lru_cache(maxsize=2048)
 def _ticker_hk_to_ak(ticker):
     """Convert '0700.HK' or '00700.HK' to '00700' (5-digit padded)."""
     code = ticker.upper().replace('.HK', '')
@@ -95,19 +90,137 @@ def _ticker_hk_to_ak(ticker):
 # Internal pivot helper
 # ---------------------------------------------------------------------------
 
-def _pivot_report(df):
-    """Pivot flat akshare HK data into {report_date: {item_code: amount}}.
+# Heavily repeated key columns, stored as category (integer codes)
+_CATEGORY_COLUMNS = ('STD_ITEM_CODE', 'STD_ITEM_NAME', 'DATE_TYPE_CODE')
+
 
-    Returns dict of dicts, plus sorted list of report dates (descending).
+def _normalize_report_df(df):
+    """Normalise a freshly fetched frame in place, once per fetch.
+
+    REPORT_DATE becomes 'YYYY-MM-DD' strings, stored as an ordered
+    categorical whose categories are the sorted dates. The repeated key
+    columns are cast to category dtype.
     """
-    grouped = {}
-    for _, row in df.iterrows():
-        date_str = str(row['REPORT_DATE'])[:10]
-        code = str(row['STD_ITEM_CODE'])
-        amount = _safe(row.get('AMOUNT'))
-        grouped.setdefault(date_str, {})[code] = amount
-    dates = sorted(grouped.keys(), reverse=True)
-    return grouped, dates
+    df['REPORT_DATE'] = pd.Categorical(
+        df['REPORT_DATE'].astype(str).str.slice(0, 10), ordered=True)
+    for col in _CATEGORY_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    return df
+
+
+def _report_dates(df):
+    """'YYYY-MM-DD' report dates of df (already so once normalised)."""
+    dates = df['REPORT_DATE']
+    if isinstance(dates.dtype, pd.CategoricalDtype):
+        return dates
+    return dates.astype(str).str.slice(0, 10)
+
+
+# Downloaded HK statements: (stock, symbol, indicator) → (expiry, frame).
+# Held in process for the same TTL as the quarterly FMP disk cache, since
+# '报告期' data changes with every interim report, and governed by the same
+# set_data_cache() switch (--no-cache / --refresh-cache).
+_report_cache = {}
+_REPORT_CACHE_MAX = 256
+
+
+def _fetch_report_em(stock, symbol, indicator='报告期'):
+    """Fetch one HK statement from eastmoney, memoised per (stock, symbol, indicator).
+
+    Returns the normalised frame (see _normalize_report_df). Use _fetch_report(), which
+    hands out copies so the cached frame is never modified.
+    """
+    from . import data as _data
+    key = (stock, symbol, indicator)
+    mode = _data._http_cache_mode
+    if mode == 'on':
+        hit = _report_cache.get(key)
+        if hit is not None and time.monotonic() < hit[0]:
+            return hit[1]
+    df = _normalize_report_df(_get_ak().stock_financial_hk_report_em(
+        stock=stock, symbol=symbol, indicator=indicator))
+    if mode != 'off':
+        _report_cache.pop(key, None)
+        while len(_report_cache) >= _REPORT_CACHE_MAX:
+            _report_cache.pop(next(iter(_report_cache)), None)
+        _report_cache[key] = (time.monotonic() + _data._HTTP_CACHE_TTL_QUARTER, df)
+    return df
+
+
+def _fetch_report(stock, symbol):
+    """All report periods ('报告期') of one HK statement, as a private copy."""
+    return _fetch_report_em(stock, symbol).copy()
+
+
+# Pivot results per frame: id(df) → (weakref to df, result). Entries drop
+# out when the frame is garbage-collected.
+_pivot_cache = {}
+
+
+def _pivot_and_fy(df):
+    """Pivot flat akshare HK data into one amount vector per report date.
+
+    Returns (grouped, dates, fy_dates, code_index):
+      grouped     {report_date: float64 array}, one slot per item code
+      dates       report dates sorted descending
+      fy_dates    set of FY dates (DATE_TYPE_CODE='001')
+      code_index  {item_code: slot in those arrays}
+    Missing / non-numeric amounts are 0.0; read single items with _item().
+
+    The result is memoised per frame — the fetch, TTM and data.py steps
+    all pivot the same full_df — so treat it as read-only.
+    """
+    key = id(df)
+    hit = _pivot_cache.get(key)
+    if hit is not None and hit[0]() is df:
+        return hit[1]
+    result = _pivot_frame(df)
+    _pivot_cache[key] = (
+        weakref.ref(df, lambda _, key=key: _pivot_cache.pop(key, None)), result)
+    return result
+
+
+def _pivot_frame(df):
+    """Uncached body of _pivot_and_fy."""
+    # Row / column positions straight from the categorical codes — the
+    # whole frame is scattered into a (date x item) matrix without a
+    # Python-level loop over rows.
+    date_cat = pd.Categorical(_report_dates(df)).remove_unused_categories()
+    code_cat = pd.Categorical(df['STD_ITEM_CODE']).remove_unused_categories()
+    amounts = pd.to_numeric(df['AMOUNT'], errors='coerce').fillna(0.0).to_numpy(dtype=float)
+    rows = date_cat.codes.astype(np.int64)
+    cols = code_cat.codes.astype(np.int64)
+    valid = (rows >= 0) & (cols >= 0)
+
+    n_codes = len(code_cat.categories)
+    mat = np.zeros((len(date_cat.categories), n_codes))
+    # Later rows win on a duplicate (date, item), as a dict update would
+    flat = (rows * n_codes + cols)[valid][::-1]
+    flat, last = np.unique(flat, return_index=True)
+    mat.flat[flat] = amounts[valid][::-1][last]
+
+    # Categories are sorted ascending — walk them backwards
+    dates = [str(d) for d in date_cat.categories[::-1]]
+    grouped = dict(zip(dates, mat[::-1]))
+    code_index = {str(c): i for i, c in enumerate(code_cat.categories)}
+
+    fy_dates = set()
+    if 'DATE_TYPE_CODE' in df.columns:
+        fy_mask = (df['DATE_TYPE_CODE'].astype(str) == '001').to_numpy() & (rows >= 0)
+        fy_dates = {str(date_cat.categories[i]) for i in np.unique(rows[fy_mask])}
+    return grouped, dates, fy_dates, code_index
+
+
+def _item(row, code_index, code):
+    """Amount of one item code in a period vector from _pivot_and_fy (0.0 if absent)."""
+    i = code_index.get(code)
+    return 0.0 if i is None else float(row[i])
+
+
+def _item_sum(row, code_index, codes):
+    """Sum of several item codes in a period vector (absent codes count as 0)."""
+    return float(row[[code_index[c] for c in codes if c in code_index]].sum())
 
 
 def _build_raw_excel_df(df):
@@ -115,22 +228,55 @@ def _build_raw_excel_df(df):
 
     Pivot: rows = STD_ITEM_NAME, columns = REPORT_DATE.
     """
-    # Get unique dates and items
-    dates = sorted(df['REPORT_DATE'].unique(), reverse=True)
-
-    pivot = df.pivot_table(
-        index='STD_ITEM_NAME',
-        columns='REPORT_DATE',
-        values='AMOUNT',
-        aggfunc='first',
-    )
+    # Plain pivot (no grouper) — keep the first non-null amount per
+    # (item, date) beforehand, which is what pivot_table(aggfunc='first')
+    # used to produce.
+    df = df.dropna(subset=['STD_ITEM_NAME', 'AMOUNT']).drop_duplicates(
+        subset=['STD_ITEM_NAME', 'REPORT_DATE'])
+    pivot = df.pivot(index='STD_ITEM_NAME', columns='REPORT_DATE', values='AMOUNT')
+    # STD_ITEM_NAME is categorical — hand back a plain, name-sorted index
+    pivot = pivot.sort_index()
+    pivot.index = pivot.index.astype(str)
     # Sort columns by date descending
     pivot = pivot.reindex(columns=sorted(pivot.columns, reverse=True))
-    # Format column names
-    pivot.columns = [str(c)[:10] for c in pivot.columns]
+    pivot.columns = pivot.columns.astype(str).rename(None)
     return pivot
 
 
+def _fetch_hk_statement(ticker, symbol, label, period, historical_periods):
+    """Fetch one HK statement and select the periods to report.
+
+    Shared by the fetch_akshare_hk_* functions: fetches '报告期' (all
+    periods, needed for TTM), filters to FY dates in annual mode
+    (DATE_TYPE_CODE='001'), keeps the latest historical_periods and builds
+    the Excel raw_df from those dates.
+
+    Returns (stock, grouped, code_index, dates, raw_df, full_df), see
+    _pivot_and_fy for grouped / code_index.
+    """
+    stock = _ticker_hk_to_ak(ticker)
+    from . import style as S
+    print(S.info(f"Fetching HK {label} from akshare for {stock}..."))
+
+    # Always fetch all periods for TTM support
+    full_df = _fetch_report(stock, symbol)
+
+    grouped, dates, fy_dates, code_index = _pivot_and_fy(full_df)
+
+    if period == 'annual':
+        # Filter to FY dates only (DATE_TYPE_CODE='001')
+        dates = [d for d in dates if d in fy_dates]
+
+    dates = dates[:historical_periods]
+
+    # Build raw_df for Excel (only the selected dates)
+    mask = full_df['REPORT_DATE'].isin(set(dates))
+    raw_df = _build_raw_excel_df(full_df[mask])
+
+    # full_df is only read downstream (TTM), so it is returned without a copy
+    return stock, grouped, code_index, dates, raw_df, full_df
+
+
 # ---------------------------------------------------------------------------
 # Income Statement
 # ---------------------------------------------------------------------------
@@ -146,15 +292,6 @@ _IS_CODES = {
 }
 
 
-def _get_fy_dates(df):
-    """Identify FY dates from a DataFrame using DATE_TYPE_CODE='001'."""
-    fy_dates = set()
-    for _, row in df.iterrows():
-        if str(row.get('DATE_TYPE_CODE', '')) == '001':
-            fy_dates.add(str(row['REPORT_DATE'])[:10])
-    return fy_dates
-
-
 def fetch_akshare_hk_income_statement(ticker, period='annual', historical_periods=5):
     """Fetch HK income statements from akshare.
 
@@ -163,29 +300,14 @@ def fetch_akshare_hk_income_statement(ticker, period='annual', historical_period
 
     Returns (result_list, raw_df, full_cumulative_df) — same triple as A-share version.
     """
-    stock = _ticker_hk_to_ak(ticker)
-    from . import style as S
-    print(S.info(f"Fetching HK income statement from akshare for {stock}..."))
-
-    # Always fetch all periods for TTM support
-    full_df = _get_ak().stock_financial_hk_report_em(
-        stock=stock, symbol='利润表', indicator='报告期')
-
-    full_cumulative_df = full_df.copy()
-    grouped, dates = _pivot_report(full_df)
-
-    if period == 'annual':
-        # Filter to FY dates only (DATE_TYPE_CODE='001')
-        fy_dates = _get_fy_dates(full_df)
-        dates = [d for d in dates if d in fy_dates]
-
-    dates = dates[:historical_periods]
+    stock, grouped, code_index, dates, raw_df, full_df = _fetch_hk_statement(
+        ticker, '利润表', 'income statement', period, historical_periods)
 
     month_to_quarter = {3: 'Q1', 6: 'Q2', 9: 'Q3', 12: 'Q4'}
     result = []
 
     for date_str in dates:
-        items = grouped.get(date_str, {})
+        row = grouped[date_str]
         year = date_str[:4]
         month = int(date_str[5:7])
 
@@ -199,20 +321,15 @@ def fetch_akshare_hk_income_statement(ticker, period='annual', historical_period
             'date': date_str,
             'period': period_name,
             'reportedCurrency': _detect_hk_currency(stock),
-            'revenue':          items.get(_IS_CODES['revenue'], 0),
-            'operatingIncome':  items.get(_IS_CODES['operating'], 0),
-            'interestExpense':  items.get(_IS_CODES['fin_cost'], 0),
-            'interestIncome':   items.get(_IS_CODES['int_income'], 0),
-            'incomeBeforeTax':  items.get(_IS_CODES['ebt'], 0),
-            'incomeTaxExpense': items.get(_IS_CODES['tax'], 0),
+            'revenue':          _item(row, code_index, _IS_CODES['revenue']),
+            'operatingIncome':  _item(row, code_index, _IS_CODES['operating']),
+            'interestExpense':  _item(row, code_index, _IS_CODES['fin_cost']),
+            'interestIncome':   _item(row, code_index, _IS_CODES['int_income']),
+            'incomeBeforeTax':  _item(row, code_index, _IS_CODES['ebt']),
+            'incomeTaxExpense': _item(row, code_index, _IS_CODES['tax']),
         })
 
-    # Build raw_df for Excel (only the selected dates)
-    selected_dates_set = set(dates)
-    mask = full_df['REPORT_DATE'].apply(lambda x: str(x)[:10] in selected_dates_set)
-    raw_df = _build_raw_excel_df(full_df[mask])
-
-    return result, raw_df, full_cumulative_df
+    return result, raw_df, full_df
 
 
 # ---------------------------------------------------------------------------
@@ -253,48 +370,31 @@ _BS_CODES = {
 }
 
 
-def _parse_hk_bs(items):
-    """Parse balance sheet items dict into FMP-compatible dict.
+# Components summed into totalDebt / totalInvestments
+_BS_DEBT_CODES = tuple(_BS_CODES[k] for k in (
+    'short_loan', 'notes_current', 'lease_current', 'long_loan',
+    'notes_noncurrent', 'lease_noncurrent', 'conv_bonds'))
+_BS_INVEST_CODES = tuple(_BS_CODES[k] for k in (
+    'associates', 'jv', 'fv_assets', 'fv_assets_current', 'other_fin_nc',
+    'other_fin_current', 'short_deposits', 'long_deposits', 'long_invest',
+    'other_invest', 'short_invest', 'securities'))
+
+
+def _parse_hk_bs(row, code_index):
+    """Parse one balance sheet period vector into FMP-compatible dict.
 
     Convention alignment with yfinance:
     - totalEquity = 总权益 (includes minority interest)
     - cashAndCashEquivalents = 现金及等价物 only (no deposits)
     - totalInvestments includes deposits (short + long term)
     """
-    total_debt = (
-        items.get(_BS_CODES['short_loan'], 0) +
-        items.get(_BS_CODES['notes_current'], 0) +
-        items.get(_BS_CODES['lease_current'], 0) +
-        items.get(_BS_CODES['long_loan'], 0) +
-        items.get(_BS_CODES['notes_noncurrent'], 0) +
-        items.get(_BS_CODES['lease_noncurrent'], 0) +
-        items.get(_BS_CODES['conv_bonds'], 0)
-    )
-
-    cash = items.get(_BS_CODES['cash'], 0)
-
-    total_investments = (
-        items.get(_BS_CODES['associates'], 0) +
-        items.get(_BS_CODES['jv'], 0) +
-        items.get(_BS_CODES['fv_assets'], 0) +
-        items.get(_BS_CODES['fv_assets_current'], 0) +
-        items.get(_BS_CODES['other_fin_nc'], 0) +
-        items.get(_BS_CODES['other_fin_current'], 0) +
-        items.get(_BS_CODES['short_deposits'], 0) +
-        items.get(_BS_CODES['long_deposits'], 0) +
-        items.get(_BS_CODES['long_invest'], 0) +
-        items.get(_BS_CODES['other_invest'], 0) +
-        items.get(_BS_CODES['short_invest'], 0) +
-        items.get(_BS_CODES['securities'], 0)
-    )
-
     return {
-        'totalDebt':                total_debt,
-        'totalEquity':              items.get(_BS_CODES['equity'], 0),
-        'minorityInterest':         items.get(_BS_CODES['minority'], 0),
-        'cashAndCashEquivalents':   cash,
-        'totalInvestments':         total_investments,
-        'totalAssets':              items.get(_BS_CODES['total_assets'], 0),
+        'totalDebt':                _item_sum(row, code_index, _BS_DEBT_CODES),
+        'totalEquity':              _item(row, code_index, _BS_CODES['equity']),
+        'minorityInterest':         _item(row, code_index, _BS_CODES['minority']),
+        'cashAndCashEquivalents':   _item(row, code_index, _BS_CODES['cash']),
+        'totalInvestments':         _item_sum(row, code_index, _BS_INVEST_CODES),
+        'totalAssets':              _item(row, code_index, _BS_CODES['total_assets']),
     }
 
 
@@ -307,34 +407,15 @@ def fetch_akshare_hk_balance_sheet(ticker, period='annual', historical_periods=5
 
     Returns (result_list, raw_df, full_df) — same triple as A-share version.
     """
-    stock = _ticker_hk_to_ak(ticker)
-    from . import style as S
-    print(S.info(f"Fetching HK balance sheet from akshare for {stock}..."))
-
-    # Always fetch all periods (needed for TTM BS lookup)
-    full_df = _get_ak().stock_financial_hk_report_em(
-        stock=stock, symbol='资产负债表', indicator='报告期')
-
-    grouped, dates = _pivot_report(full_df)
-
-    if period == 'annual':
-        # Filter to FY dates only (DATE_TYPE_CODE='001')
-        fy_dates = _get_fy_dates(full_df)
-        dates = [d for d in dates if d in fy_dates]
-
-    dates = dates[:historical_periods]
+    _, grouped, code_index, dates, raw_df, full_df = _fetch_hk_statement(
+        ticker, '资产负债表', 'balance sheet', period, historical_periods)
 
     result = []
     for date_str in dates:
-        items = grouped.get(date_str, {})
-        bs_dict = _parse_hk_bs(items)
+        bs_dict = _parse_hk_bs(grouped[date_str], code_index)
         bs_dict['date'] = date_str          # add date for matching
         result.append(bs_dict)
 
-    selected_dates_set = set(dates)
-    mask = full_df['REPORT_DATE'].apply(lambda x: str(x)[:10] in selected_dates_set)
-    raw_df = _build_raw_excel_df(full_df[mask])
-
     return result, raw_df, full_df
 
 
@@ -355,20 +436,26 @@ _WC_PREFIX = '002'
 _WC_SUBTOTAL = '002999'
 
 
-def _parse_hk_cf(items):
-    """Parse cash flow items dict into FMP-compatible dict."""
-    da = items.get(_CF_CODES['da'], 0)
+def _wc_cols(code_index):
+    """Slots of the working capital items (002xxx, excluding subtotal 002999)."""
+    return np.array([i for c, i in code_index.items()
+                     if c.startswith(_WC_PREFIX) and c != _WC_SUBTOTAL], dtype=np.intp)
+
+
+def _parse_hk_cf(row, code_index, wc_cols):
+    """Parse one cash flow period vector into FMP-compatible dict.
+
+    wc_cols: working capital slots, see _wc_cols().
+    """
+    da = _item(row, code_index, _CF_CODES['da'])
 
     # CapEx: negative (FMP convention: cash outflow is negative)
-    capex_fixed = items.get(_CF_CODES['capex_fixed'], 0)
-    capex_intang = items.get(_CF_CODES['capex_intang'], 0)
+    capex_fixed = _item(row, code_index, _CF_CODES['capex_fixed'])
+    capex_intang = _item(row, code_index, _CF_CODES['capex_intang'])
     capex = -(capex_fixed + capex_intang)
 
     # Working capital change: sum all 002xxx items except 002999 subtotal
-    wc_change = sum(
-        v for k, v in items.items()
-        if k.startswith(_WC_PREFIX) and k != _WC_SUBTOTAL
-    )
+    wc_change = float(row[wc_cols].sum())
 
     return {
         'depreciationAndAmortization': da,
@@ -386,34 +473,15 @@ def fetch_akshare_hk_cashflow(ticker, period='annual', historical_periods=5):
     Returns (result_list, raw_df, full_cumulative_df).
     IMPORTANT: quarterly data from akshare is cumulative (YTD), same as A-shares.
     """
-    stock = _ticker_hk_to_ak(ticker)
-    from . import style as S
-    print(S.info(f"Fetching HK cash flow statement from akshare for {stock}..."))
-
-    # Always fetch all periods for TTM support
-    full_df = _get_ak().stock_financial_hk_report_em(
-        stock=stock, symbol='现金流量表', indicator='报告期')
-
-    full_cumulative_df = full_df.copy()
-    grouped, dates = _pivot_report(full_df)
-
-    if period == 'annual':
-        # Filter to FY dates only (DATE_TYPE_CODE='001')
-        fy_dates = _get_fy_dates(full_df)
-        dates = [d for d in dates if d in fy_dates]
-
-    dates = dates[:historical_periods]
+    _, grouped, code_index, dates, raw_df, full_df = _fetch_hk_statement(
+        ticker, '现金流量表', 'cash flow statement', period, historical_periods)
 
+    wc_cols = _wc_cols(code_index)
     result = []
     for date_str in dates:
-        items = grouped.get(date_str, {})
-        result.append(_parse_hk_cf(items))
-
-    selected_dates_set = set(dates)
-    mask = full_df['REPORT_DATE'].apply(lambda x: str(x)[:10] in selected_dates_set)
-    raw_df = _build_raw_excel_df(full_df[mask])
+        result.append(_parse_hk_cf(grouped[date_str], code_index, wc_cols))
 
-    return result, raw_df, full_cumulative_df
+    return result, raw_df, full_df
 
 
 # ---------------------------------------------------------------------------
@@ -426,43 +494,41 @@ def fetch_akshare_hk_key_metrics(ticker, balance_sheets, income_statements,
 
     No additional API call needed — computed from BS and IS data.
     Returns list of dicts with same keys as A-share version.
+    All periods are computed at once on numpy arrays.
     """
-    result = []
-    for i in range(len(balance_sheets)):
-        bs = balance_sheets[i]
-
-        total_assets = bs.get('totalAssets', 0) or 1
-        total_debt = bs.get('totalDebt', 0) or 0
-        total_equity = bs.get('totalEquity', 0) or 0
-        debt_to_assets = total_debt / total_assets if total_assets else 0
+    n = len(balance_sheets)
+    # Periods without an income statement keep ROIC / ROE at 0
+    incomes = list(income_statements[:n]) + [{}] * (n - len(income_statements))
+
+    def _col(rows, key):
+        return np.array([rows[i].get(key, 0) or 0 for i in range(n)], dtype=float)
+
+    total_assets = np.array([bs.get('totalAssets', 0) or 1 for bs in balance_sheets],
+                            dtype=float)
+    total_debt = _col(balance_sheets, 'totalDebt')
+    total_equity = _col(balance_sheets, 'totalEquity')
+    cash = _col(balance_sheets, 'cashAndCashEquivalents')
+    investments = _col(balance_sheets, 'totalInvestments')
+    ebit = _col(incomes, 'operatingIncome')
+    ebt = _col(incomes, 'incomeBeforeTax')
+    tax = _col(incomes, 'incomeTaxExpense')
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        debt_to_assets = total_debt / total_assets
+        tax_rate = np.where(ebt != 0, tax / ebt, 0.0)
 
         # ROIC = EBIT * (1 - tax rate) / invested capital
-        roic_val = 0
-        roe_val = 0
-        if i < len(income_statements):
-            inc = income_statements[i]
-            ebit = inc.get('operatingIncome', 0) or 0
-            ebt = inc.get('incomeBeforeTax', 0) or 0
-            tax = inc.get('incomeTaxExpense', 0) or 0
-            tax_rate = tax / ebt if ebt else 0
-
-            cash = bs.get('cashAndCashEquivalents', 0) or 0
-            investments = bs.get('totalInvestments', 0) or 0
-            invested_capital = total_debt + total_equity - cash - investments
-            if invested_capital > 0:
-                roic_val = ebit * (1 - tax_rate) / invested_capital
-
-            net_income = ebt - tax
-            if total_equity > 0:
-                roe_val = net_income / total_equity
+        invested_capital = total_debt + total_equity - cash - investments
+        roic = np.where(invested_capital > 0,
+                        ebit * (1 - tax_rate) / invested_capital, 0.0)
 
-        result.append({
-            'debtToAssets': debt_to_assets,
-            'roic': roic_val,
-            'roe': roe_val,
-        })
+        net_income = ebt - tax
+        roe = np.where(total_equity > 0, net_income / total_equity, 0.0)
 
-    return result
+    return [
+        {'debtToAssets': d, 'roic': r, 'roe': e}
+        for d, r, e in zip(debt_to_assets.tolist(), roic.tolist(), roe.tolist())
+    ]
 
 
 # ---------------------------------------------------------------------------
@@ -544,6 +610,27 @@ def fetch_akshare_hk_company_profile(ticker):
 # TTM helpers (reuse cumulative YTD method, same as A-shares)
 # ---------------------------------------------------------------------------
 
+def _find_ttm_anchors(dates, fy_dates, latest_date):
+    """Find the dates a TTM figure is built from, in one pass over dates.
+
+    dates must be sorted descending. Returns (prior_fy_date, prior_same_date):
+    the most recent FY before latest_date, and the same-period YTD (same
+    month/day) of an earlier year. Either is None when not found.
+    """
+    target_mmdd = latest_date[5:]  # "MM-DD"
+    prior_fy_date = prior_same_date = None
+    for d in dates:
+        if d >= latest_date:
+            continue
+        if prior_fy_date is None and d in fy_dates:
+            prior_fy_date = d
+        if prior_same_date is None and d[5:] == target_mmdd and d[:4] != latest_date[:4]:
+            prior_same_date = d
+        if prior_fy_date and prior_same_date:
+            break
+    return prior_fy_date, prior_same_date
+
+
 def _compute_hk_ttm_income(ticker, full_cumulative_df=None):
     """Compute TTM income for HK stocks using YTD cumulative method.
 
@@ -557,13 +644,11 @@ def _compute_hk_ttm_income(ticker, full_cumulative_df=None):
     if full_cumulative_df is None or full_cumulative_df.empty:
         return None
 
-    grouped, dates = _pivot_report(full_cumulative_df)
+    # FY dates come from DATE_TYPE_CODE (works for any FY month)
+    grouped, dates, fy_dates, code_index = _pivot_and_fy(full_cumulative_df)
     if len(dates) < 2:
         return None
 
-    # Identify FY dates using DATE_TYPE_CODE (works for any FY month)
-    fy_dates = _get_fy_dates(full_cumulative_df)
-
     latest_date = dates[0]
     latest_month = int(latest_date[5:7])
     latest_year = int(latest_date[:4])
@@ -572,34 +657,15 @@ def _compute_hk_ttm_income(ticker, full_cumulative_df=None):
     if latest_date in fy_dates:
         return None
 
-    latest_items = grouped[latest_date]
-
-    # Find prior FY date (the most recent FY before the latest date)
-    prior_fy_date = None
-    for d in dates:
-        if d in fy_dates and d < latest_date:
-            prior_fy_date = d
-            break
-    if not prior_fy_date:
+    prior_fy_date, prior_same_date = _find_ttm_anchors(dates, fy_dates, latest_date)
+    if not prior_fy_date or not prior_same_date:
         return None
-    prior_fy_items = grouped[prior_fy_date]
 
-    # Find prior same-period YTD (same month/day, one year earlier)
-    target_mmdd = latest_date[5:]  # "MM-DD"
-    prior_same_date = None
-    for d in dates:
-        if d < latest_date and d[5:] == target_mmdd and d[:4] != latest_date[:4]:
-            prior_same_date = d
-            break
-    if not prior_same_date:
-        return None
-    prior_same_items = grouped[prior_same_date]
+    # TTM = latest YTD + (prior FY - prior same-period YTD), for every item at once
+    ttm_row = grouped[latest_date] + grouped[prior_fy_date] - grouped[prior_same_date]
 
-    # TTM = latest YTD + (prior FY - prior same-period YTD)
     def ttm_val(code):
-        return (latest_items.get(code, 0) +
-                prior_fy_items.get(code, 0) -
-                prior_same_items.get(code, 0))
+        return _item(ttm_row, code_index, code)
 
     month_to_quarter = {3: 'Q1', 6: 'Q2', 9: 'Q3'}
 
@@ -628,13 +694,11 @@ def _compute_hk_ttm_cashflow(ticker, full_cumulative_df=None):
     if full_cumulative_df is None or full_cumulative_df.empty:
         return None
 
-    grouped, dates = _pivot_report(full_cumulative_df)
+    # FY dates come from DATE_TYPE_CODE (works for any FY month)
+    grouped, dates, fy_dates, code_index = _pivot_and_fy(full_cumulative_df)
     if len(dates) < 2:
         return None
 
-    # Identify FY dates using DATE_TYPE_CODE (works for any FY month)
-    fy_dates = _get_fy_dates(full_cumulative_df)
-
     latest_date = dates[0]
     latest_year = int(latest_date[:4])
 
@@ -642,33 +706,14 @@ def _compute_hk_ttm_cashflow(ticker, full_cumulative_df=None):
     if latest_date in fy_dates:
         return None
 
-    latest_items = grouped[latest_date]
-
-    # Find prior FY date (most recent FY before latest date)
-    prior_fy_date = None
-    for d in dates:
-        if d in fy_dates and d < latest_date:
-            prior_fy_date = d
-            break
-    if not prior_fy_date:
+    prior_fy_date, prior_same_date = _find_ttm_anchors(dates, fy_dates, latest_date)
+    if not prior_fy_date or not prior_same_date:
         return None
-    prior_fy_items = grouped[prior_fy_date]
 
-    # Find prior same-period YTD (same month/day, one year earlier)
-    target_mmdd = latest_date[5:]
-    prior_same_date = None
-    for d in dates:
-        if d < latest_date and d[5:] == target_mmdd and d[:4] != latest_date[:4]:
-            prior_same_date = d
-            break
-    if not prior_same_date:
-        return None
-    prior_same_items = grouped[prior_same_date]
+    ttm_row = grouped[latest_date] + grouped[prior_fy_date] - grouped[prior_same_date]
 
     def ttm_val(code):
-        return (latest_items.get(code, 0) +
-                prior_fy_items.get(code, 0) -
-                prior_same_items.get(code, 0))
+        return _item(ttm_row, code_index, code)
 
     # D&A
     da = ttm_val(_CF_CODES['da'])
@@ -676,15 +721,8 @@ def _compute_hk_ttm_cashflow(ticker, full_cumulative_df=None):
     # CapEx
     capex = -(ttm_val(_CF_CODES['capex_fixed']) + ttm_val(_CF_CODES['capex_intang']))
 
-    # Working capital change
-    def ttm_wc():
-        """Sum all 002xxx items TTM."""
-        wc_codes = set()
-        for items in [latest_items, prior_fy_items, prior_same_items]:
-            wc_codes.update(k for k in items if k.startswith(_WC_PREFIX) and k != _WC_SUBTOTAL)
-        return sum(ttm_val(code) for code in wc_codes)
-
-    wc = ttm_wc()
+    # Working capital change: all 002xxx items TTM
+    wc = float(ttm_row[_wc_cols(code_index)].sum())
 
     return {
         'depreciationAndAmortization': da,
@@ -8,6 +8,8 @@ TERMINAL_RISK_PREMIUM = 0.05  # 5%
 
 TERMINAL_RONIC_PREMIUM = 0.05
 
+MIN_GAP_PCT = 2.0  # DCF 估值与股价差异低于 2% 时跳过 AI 差异分析
+
 """
 Mature companies tend to have costs of INVESTED_CAPITAL closer to the market average. 
 While the riskfree rate (e.g., 3-4%) is a close approximation of the average, you can use a slightly higher number (riskfree rate + 6%) for mature companies in riskier businesses and a slightly lower number (risfree rate + 4%) for safer companies
@@ -1,9 +1,20 @@
-from urllib.request import urlopen
-import os, re, json, traceback
+import functools, hashlib, json, os, re, tempfile, time, traceback
+import numpy as np
 import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from . import style as S
 from .constants import CHINA_DEFAULT_BETA
 
+# orjson is an optional speedup for decoding FMP responses (large statement
+# and forex lists); its JSONDecodeError subclasses json.JSONDecodeError.
+try:
+    import orjson as _orjson
+    _json_loads = _orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 # Lazy-loaded: akshare is only needed for A-shares and takes ~1s to import
 ak = None
 
@@ -162,18 +173,124 @@ def get_api_url(requested_data, ticker, period, apikey):
         base_url = f'https://financialmodelingprep.com/stable/{requested_data}?symbol={ticker}&apikey={apikey}'
     return base_url if period == 'annual' else f'{base_url}&period=quarter'
 
-def get_jsonparsed_data(url, timeout=15):
+# Shared HTTP session: keeps the TLS connection to FMP alive across calls
+# (and across the parallel statement fetches) instead of a new handshake
+# per request. Rate-limit / transient 5xx replies are retried with backoff;
+# read timeouts are not, so a hanging endpoint still fails after `timeout`.
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16, pool_maxsize=16,
+    max_retries=Retry(total=3, read=0, backoff_factor=0.3,
+                      status_forcelist=(429, 500, 502, 503, 504))))
+
+
+# On-disk cache for FMP financial statements. Statements only change when a
+# company reports, so re-running a valuation (or the web app re-fetching the
+# same ticker) should not spend API quota. Quotes, profiles and forex never
+# go to disk — they carry live prices; forex quotes are only memoised in
+# process for an hour (see _ttl_memo below).
+_HTTP_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.cache', 'fmp')
+_HTTP_CACHE_TTL = 24 * 3600           # seconds, annual statements
+_HTTP_CACHE_TTL_QUARTER = 6 * 3600    # seconds, quarterly statements
+_http_cache_mode = 'on'               # 'on' | 'off' | 'refresh'
+
+
+def set_data_cache(mode):
+    """Set how statement fetches use the disk cache (--no-cache / --refresh-cache).
+
+    Args:
+        mode: 'on' (read + write), 'off' (neither), or 'refresh' (skip reads, write fresh results).
+    """
+    global _http_cache_mode
+    if mode not in ('on', 'off', 'refresh'):
+        raise ValueError(f"未知的缓存模式: {mode}")
+    _http_cache_mode = mode
+
+
+def _http_cache_path(url):
+    # The URL carries the API key; hash it so the key never lands in a filename.
+    return os.path.join(_HTTP_CACHE_DIR, hashlib.sha256(url.encode('utf-8')).hexdigest()[:32] + '.json')
+
+
+def _http_cache_load(path, ttl):
+    """Return the cached JSON at *path*, or None if missing, stale or unreadable."""
+    if _http_cache_mode != 'on':
+        return None
+    try:
+        if time.time() - os.path.getmtime(path) > ttl:
+            return None
+        with open(path, 'rb') as f:
+            return _json_loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _http_cache_store(path, body):
+    """Write the raw response *body* to the cache. Failures are ignored — the cache is optional."""
+    if _http_cache_mode == 'off':
+        return
+    tmp_path = None
     try:
-        response = urlopen(url, timeout=timeout)
-        data = response.read().decode('utf-8')
-        json_data = json.loads(data)
+        os.makedirs(_HTTP_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=_HTTP_CACHE_DIR)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+    except OSError:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_jsonparsed_data(url, timeout=15, cache=False):
+    """GET *url* and return the parsed JSON.
+
+    With ``cache=True`` a non-empty result is kept on disk for 24 h
+    (6 h for ``period=quarter`` URLs) and served from there on later calls.
+    """
+    cache_path = None
+    if cache:
+        ttl = _HTTP_CACHE_TTL_QUARTER if 'period=quarter' in url else _HTTP_CACHE_TTL
+        cache_path = _http_cache_path(url)
+        cached = _http_cache_load(cache_path, ttl)
+        if cached is not None:
+            return cached
+    try:
+        response = _SESSION.get(url, timeout=timeout)
+        response.raise_for_status()
+        json_data = _json_loads(response.content)
         if isinstance(json_data, dict) and "Error Message" in json_data:
             raise ValueError(f"Error while requesting data from '{url}'. Error Message: '{json_data['Error Message']}'.")
-        return json_data
     except Exception as e:
         print(f"Error retrieving {url}: {e}")
         raise
-
+    if cache_path is not None and json_data:
+        _http_cache_store(cache_path, response.content)
+    return json_data
+
+# Per-process memo for the global FMP tables (forex quotes, market risk
+# premium): every valuation in a session reads the same table, so fetch it
+# once per TTL and per API key. Empty/failed results are not memoised.
+_ttl_memo_cache = {}   # (function name, apikey) → (expiry, value)
+
+
+def _ttl_memo(ttl):
+    """Memoise a single-argument ``fn(apikey)`` for *ttl* seconds."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(apikey):
+            key = (fn.__name__, apikey)
+            hit = _ttl_memo_cache.get(key)
+            if hit is not None and time.monotonic() < hit[0]:
+                return hit[1]
+            value = fn(apikey)
+            if value:
+                _ttl_memo_cache[key] = (time.monotonic() + ttl, value)
+            return value
+        return wrapper
+    return decorator
+
+
+@_ttl_memo(ttl=3600)
 def fetch_forex_data(apikey):
     # Stable API has no free bulk forex endpoint; use legacy (still active)
     url = f'https://financialmodelingprep.com/api/v3/quotes/forex?apikey={apikey}'
@@ -222,6 +339,7 @@ def fetch_forex_akshare(from_currency, to_currency):
         return None
 
 
+@_ttl_memo(ttl=3600)
 def fetch_market_risk_premium(apikey):
     url = f'https://financialmodelingprep.com/stable/market-risk-premium?apikey={apikey}'
     data = get_jsonparsed_data(url)
@@ -340,16 +458,13 @@ def _build_raw_excel_df(df):
     return raw
 
 
-def _calc_akshare_ebit(row):
-    """Calculate EBIT from a single akshare profit sheet row (China GAAP).
+_AKSHARE_EBIT_FIELDS = ['OPERATE_PROFIT', 'INVEST_INCOME', 'FAIRVALUE_CHANGE_INCOME',
+                        'OTHER_INCOME', 'ASSET_DISPOSAL_INCOME', 'CREDIT_IMPAIRMENT_INCOME',
+                        'ASSET_IMPAIRMENT_INCOME', 'FINANCE_EXPENSE']
 
-    EBIT = 营业利润 - 投资收益 - 公允价值变动收益 - 其他收益
-           - 资产处置收益 - 信用减值损失 - 资产减值损失 + 财务费用
-    """
-    fields = ['OPERATE_PROFIT', 'INVEST_INCOME', 'FAIRVALUE_CHANGE_INCOME',
-              'OTHER_INCOME', 'ASSET_DISPOSAL_INCOME', 'CREDIT_IMPAIRMENT_INCOME',
-              'ASSET_IMPAIRMENT_INCOME', 'FINANCE_EXPENSE']
-    vals = {f: _safe_numeric(row.get(f, 0)) for f in fields}
+
+def _akshare_ebit(vals):
+    """EBIT from *vals* keyed by _AKSHARE_EBIT_FIELDS (scalars or whole columns)."""
     return (vals['OPERATE_PROFIT']
             - vals['INVEST_INCOME']
             - vals['FAIRVALUE_CHANGE_INCOME']
@@ -360,6 +475,15 @@ def _calc_akshare_ebit(row):
             + vals['FINANCE_EXPENSE'])
 
 
+def _calc_akshare_ebit(row):
+    """Calculate EBIT from a single akshare profit sheet row (China GAAP).
+
+    EBIT = 营业利润 - 投资收益 - 公允价值变动收益 - 其他收益
+           - 资产处置收益 - 信用减值损失 - 资产减值损失 + 财务费用
+    """
+    return _akshare_ebit({f: _safe_numeric(row.get(f, 0)) for f in _AKSHARE_EBIT_FIELDS})
+
+
 def _ticker_to_ak_symbol(ticker):
     """Convert FMP ticker to akshare symbol: 600519.SS -> SH600519, 002594.SZ -> SZ002594."""
     t = ticker.upper()
@@ -622,8 +746,19 @@ def fetch_akshare_income_statement(ticker, period='annual', historical_periods=5
     month_to_quarter = {3: 'Q1', 6: 'Q2', 9: 'Q3', 12: 'Q4'}
     result = []
 
-    for _, row in df.iterrows():
-        date_str = str(row['REPORT_DATE'])[:10]
+    # Coerce every field once per column (missing column / NaN → 0) instead
+    # of per row and per field with _safe_numeric.
+    vals = (df.reindex(columns=_AKSHARE_EBIT_FIELDS + ['OPERATE_INCOME', 'FE_INTEREST_EXPENSE',
+                                                     'FE_INTEREST_INCOME', 'TOTAL_PROFIT', 'INCOME_TAX'])
+              .apply(pd.to_numeric, errors='coerce')
+              .fillna(0.0))
+    ebit_col = _akshare_ebit(vals)
+
+    for date_str, revenue, ebit, interest_expense_val, interest_income_val, total_profit, income_tax in zip(
+            df['REPORT_DATE'].astype(str).str[:10].tolist(),
+            vals['OPERATE_INCOME'].tolist(), ebit_col.tolist(),
+            vals['FE_INTEREST_EXPENSE'].tolist(), vals['FE_INTEREST_INCOME'].tolist(),
+            vals['TOTAL_PROFIT'].tolist(), vals['INCOME_TAX'].tolist()):
         year = date_str[:4]
         month = int(date_str[5:7])
 
@@ -632,14 +767,6 @@ def fetch_akshare_income_statement(ticker, period='annual', historical_periods=5
         else:
             period_name = month_to_quarter.get(month, f'Q{(month - 1) // 3 + 1}')
 
-        revenue = _safe_numeric(row.get('OPERATE_INCOME', 0))
-        ebit = _calc_akshare_ebit(row)
-
-        interest_expense_val = _safe_numeric(row.get('FE_INTEREST_EXPENSE', 0))
-        interest_income_val = _safe_numeric(row.get('FE_INTEREST_INCOME', 0))
-        total_profit = _safe_numeric(row.get('TOTAL_PROFIT', 0))
-        income_tax = _safe_numeric(row.get('INCOME_TAX', 0))
-
         result.append({
             'calendarYear': year,
             'date': date_str,
@@ -1176,7 +1303,7 @@ def get_historical_financials(ticker, period='annual', apikey='', historical_per
             if not is_jpn_stock(ticker):
                 urls['ratios'] = get_api_url('ratios', ticker, period, apikey)
             with ThreadPoolExecutor(max_workers=len(urls)) as executor:
-                futures = {k: executor.submit(get_jsonparsed_data, v) for k, v in urls.items()}
+                futures = {k: executor.submit(get_jsonparsed_data, v, cache=True) for k, v in urls.items()}
             income_statement = futures['income'].result()[:historical_periods]
             balance_sheet = futures['balance'].result()[:historical_periods]
             cashflow_statement = futures['cashflow'].result()[:historical_periods]
@@ -1230,12 +1357,16 @@ def get_historical_financials(ticker, period='annual', apikey='', historical_per
 
         summary_data = []
         tax_rates = []
+        # Market checks are loop-invariant; resolve them once instead of per field
+        _is_a = is_a_share(ticker)
+        _by_index = _is_a or is_hk_stock(ticker)
+        _cf_always = _is_a or (is_hk_stock(ticker) and period == 'annual')
 
         for i in range(len(income_statement)):
             inc = income_statement[i]
             inc_date = inc.get('date', '')
 
-            if is_a_share(ticker) or is_hk_stock(ticker):
+            if _by_index:
                 # A-shares & HK (akshare): lists always aligned by index
                 bs = balance_sheet[i] if i < len(balance_sheet) else {}
                 cf = cashflow_statement[i] if i < len(cashflow_statement) else _empty_cf
@@ -1246,6 +1377,7 @@ def get_historical_financials(ticker, period='annual', apikey='', historical_per
                 km = km_by_date.get(inc_date) or (key_metrics[i] if i < len(key_metrics) else _empty_km)
 
             ebit = (inc.get('operatingIncome', 0) or 0)
+            revenue = inc.get('revenue', 0) or 0
 
             income_before_tax = inc.get('incomeBeforeTax', 0) or 0
             income_tax_expense = inc.get('incomeTaxExpense', 0) or 0
@@ -1256,7 +1388,7 @@ def get_historical_financials(ticker, period='annual', apikey='', historical_per
                               (bs.get('totalEquity', 0) or 0) - \
                               (bs.get('cashAndCashEquivalents', 0) or 0) - \
                               (bs.get('totalInvestments', 0) or 0)
-            revenue_to_invested_capital = (inc.get('revenue', 0) or 0) / invested_capital if invested_capital != 0 else 0
+            revenue_to_invested_capital = revenue / invested_capital if invested_capital != 0 else 0
             total_reinvestments = -(cf.get('investmentsInPropertyPlantAndEquipment', 0) or 0) + \
                                  -(cf.get('changeInWorkingCapital', 0) or 0) - \
                                  (cf.get('depreciationAndAmortization', 0) or 0)
@@ -1266,7 +1398,7 @@ def get_historical_financials(ticker, period='annual', apikey='', historical_per
             # For prev_total_debt, look up the previous income_statement date
             if i > 0:
                 prev_inc_date = income_statement[i - 1].get('date', '')
-                if is_a_share(ticker) or is_hk_stock(ticker):
+                if _by_index:
                     prev_total_debt = balance_sheet[i - 1].get('totalDebt', 0) or 0 if i - 1 < len(balance_sheet) else total_debt
                 else:
                     prev_bs = bs_by_date.get(prev_inc_date)
@@ -1301,8 +1433,7 @@ def get_historical_financials(ticker, period='annual', apikey='', historical_per
                     prev_index = i + 4
                 if prev_index < len(income_statement):
                     prev_revenue = income_statement[prev_index].get('revenue', 0) or 0
-                    current_revenue = inc.get('revenue', 0) or 0
-                    revenue_growth = (current_revenue - prev_revenue) / prev_revenue * 100 if prev_revenue != 0 else 0
+                    revenue_growth = (revenue - prev_revenue) / prev_revenue * 100 if prev_revenue != 0 else 0
 
                     prev_ebit = income_statement[prev_index].get('operatingIncome', 0) or 0
                     current_ebit = ebit or 0
@@ -1314,7 +1445,7 @@ def get_historical_financials(ticker, period='annual', apikey='', historical_per
                 revenue_growth = 0
                 ebit_growth = 0
 
-            revenue_val = (inc.get('revenue', 0) or 0) / 1_000_000
+            revenue_val = revenue / 1_000_000
             ebit_val = (ebit or 0) / 1_000_000
             da_val = (cf.get('depreciationAndAmortization', 0) or 0) / 1_000_000
             wc_val = -(cf.get('changeInWorkingCapital', 0) or 0) / 1_000_000
@@ -1329,7 +1460,7 @@ def get_historical_financials(ticker, period='annual', apikey='', historical_per
             ebit_margin = (ebit / (inc.get('revenue', 0) or 1)) * 100 if inc.get('revenue', 0) != 0 else 0
 
             # Tag whether this quarter has actual cashflow data (vs. date-gap fill with zeros)
-            _has_cf = is_a_share(ticker) or (is_hk_stock(ticker) and period == 'annual') or (cf is not _empty_cf)
+            _has_cf = _cf_always or (cf is not _empty_cf)
 
             data = {
                 'Calendar Year': inc.get('calendarYear', inc.get('fiscalYear', 'N/A')),
@@ -1367,7 +1498,7 @@ def get_historical_financials(ticker, period='annual', apikey='', historical_per
                 'ROIC (%)': ((km.get('roic', 0) or 0) * 100) or (ebit * (1 - tax_rate) / invested_capital * 100 if invested_capital > 0 else 0),
                 'ROE (%)': ((km.get('roe', 0) or 0) * 100) or ((income_before_tax - income_tax_expense) / (bs.get('totalEquity', 0) or 1) * 100 if (bs.get('totalEquity', 0) or 0) > 0 else 0),
             }
-            if not is_a_share(ticker):
+            if not _is_a:
                 data['Dividend Yield (%)'] = (km.get('dividendYield', 0) or 0) * 100
                 _payout = (km.get('payoutRatio', 0) or 0) * 100
                 if not _payout:
@@ -1507,7 +1638,7 @@ def get_historical_financials(ticker, period='annual', apikey='', historical_per
                     from .akshare_hk_data import (
                         _compute_hk_ttm_income,
                         _compute_hk_ttm_cashflow,
-                        _pivot_report as _hk_pivot,
+                        _pivot_and_fy as _hk_pivot,
                         _parse_hk_bs as _parse_hk_bs_items,
                     )
                     ttm_income = None
@@ -1519,10 +1650,8 @@ def get_historical_financials(ticker, period='annual', apikey='', historical_per
 
                         # Check if TTM skipped due to insufficient data (not because latest IS FY)
                         if ttm_income is None and _full_income_df is not None:
-                            from .akshare_hk_data import _get_fy_dates as _hk_get_fy_dates
-                            _hk_grouped, _hk_dates = _hk_pivot(_full_income_df)
+                            _hk_grouped, _hk_dates, _hk_fy_set, _ = _hk_pivot(_full_income_df)
                             if _hk_dates:
-                                _hk_fy_set = _hk_get_fy_dates(_full_income_df)
                                 _hk_latest = _hk_dates[0]
                                 if _hk_latest not in _hk_fy_set:
                                     print(S.muted(f"  ⓘ 最新报告期 ({_hk_latest}) 数据不足以计算 TTM，使用最近年度数据作为估值基础。"))
@@ -1581,10 +1710,10 @@ def get_historical_financials(ticker, period='annual', apikey='', historical_per
                         # BS: look up latest quarterly BS from full_bs_df
                         _akshare_latest_q_bs = {}
                         if _full_bs_df is not None and _ttm_latest_date:
-                            _hk_bs_grouped, _hk_bs_dates = _hk_pivot(_full_bs_df)
+                            _hk_bs_grouped, _hk_bs_dates, _, _hk_bs_codes = _hk_pivot(_full_bs_df)
                             for _bd in _hk_bs_dates:
                                 if _bd <= _ttm_latest_date:
-                                    _akshare_latest_q_bs = _parse_hk_bs_items(_hk_bs_grouped[_bd])
+                                    _akshare_latest_q_bs = _parse_hk_bs_items(_hk_bs_grouped[_bd], _hk_bs_codes)
                                     break
                     else:
                         if period == 'annual':
@@ -1674,7 +1803,7 @@ def get_historical_financials(ticker, period='annual', apikey='', historical_per
                         'cashflow': get_api_url('cash-flow-statement', ticker, 'quarter', apikey),
                     }
                     with ThreadPoolExecutor(max_workers=3) as ex:
-                        q_futures = {k: ex.submit(get_jsonparsed_data, v) for k, v in q_urls.items()}
+                        q_futures = {k: ex.submit(get_jsonparsed_data, v, cache=True) for k, v in q_urls.items()}
                     q_inc = q_futures['income'].result()[:8]
                     q_bs = q_futures['balance'].result()[:8]
                     q_cf = q_futures['cashflow'].result()[:8]
@@ -1969,9 +2098,16 @@ def get_historical_financials(ticker, period='annual', apikey='', historical_per
             if '_ttm_note' in d:
                 ttm_note = d.pop('_ttm_note')
 
-        summary_df = pd.DataFrame(summary_data).T
-        summary_df.columns = summary_df.iloc[0]
-        summary_df = summary_df[1:]
+        # Build the periods-as-columns frame directly rather than constructing
+        # it row-wise and transposing: the first key ('Calendar Year') becomes
+        # the column header, rows keep first-seen key order, gaps are NaN.
+        _row_names = list(dict.fromkeys(k for d in summary_data for k in d))
+        _header = _row_names[0]
+        summary_df = pd.DataFrame(
+            [[d.get(k, float('nan')) for d in summary_data] for k in _row_names[1:]],
+            index=_row_names[1:],
+            columns=pd.Index([d.get(_header, float('nan')) for d in summary_data], name=_header, dtype=object),
+            dtype=object)
 
         income_df = pd.DataFrame(income_statement).T
         balance_df = pd.DataFrame(balance_sheet).T
@@ -2032,15 +2168,18 @@ def format_summary_df(summary_df):
                   'ROIC (%)', 'ROE (%)', 'Dividend Yield (%)', 'Payout Ratio (%)']
     SECTION_HEADERS = ['▸ Profitability', '▸ Reinvestment', '▸ Capital Structure', '▸ Key Ratios']
 
-    for index in df.index:
-        if index in AMOUNT_ROWS:
-            df.loc[index] = pd.to_numeric(df.loc[index], errors='coerce').apply(
-                lambda x: f"{int(x):,}" if pd.notnull(x) else 'N/A')
-        elif index in RATIO_ROWS:
-            df.loc[index] = pd.to_numeric(df.loc[index], errors='coerce').apply(
-                lambda x: f"{x:.1f}" if pd.notnull(x) else 'N/A')
-        elif index in SECTION_HEADERS:
-            df.loc[index] = [''] * len(df.columns)
+    # Format each row group as one block: a single to_numeric over the flattened
+    # cells, one pass over the plain floats, then one positional write back.
+    def _format_block(rows, fmt):
+        pos = np.flatnonzero(df.index.isin(rows))
+        if pos.size:
+            block = df.iloc[pos].to_numpy()
+            nums = pd.to_numeric(block.ravel(), errors='coerce').astype(float).reshape(block.shape).tolist()
+            df.iloc[pos] = [[fmt(x) if x == x else 'N/A' for x in row] for row in nums]
+
+    _format_block(AMOUNT_ROWS, lambda x: f"{int(x):,}")
+    _format_block(RATIO_ROWS, lambda x: f"{x:.1f}")
+    df.iloc[np.flatnonzero(df.index.isin(SECTION_HEADERS))] = ''
 
     # Rename for display: EBIT → Operating Profit (EBIT)
     _DISPLAY_RENAME = {'EBIT': 'Operating Profit (EBIT)'}
@@ -3,8 +3,8 @@
 
 import io
 import os
-import re
 import shutil
+from .ai_analyst import _split_adjusted_price
 from .constants import TERMINAL_RISK_PREMIUM
 
 # Paths are set once at import time by init_paths()
@@ -153,7 +153,7 @@ def write_to_excel(filename, base_year_data, financial_data, valuation_params,
         if gap_analysis_result.get('adjusted_price') is not None:
             ws_gap.cell(row=6, column=1).value = f"修正后估值: {gap_analysis_result['adjusted_price']:,.2f} {currency}"
 
-        analysis_text = re.sub(r'\n?\s*ADJUSTED_PRICE:.*$', '', gap_analysis_result['analysis_text']).strip()
+        analysis_text = _split_adjusted_price(gap_analysis_result['analysis_text'])[0]
         for i, line in enumerate(analysis_text.split('\n'), start=8):
             ws_gap.cell(row=i, column=1).value = line
         ws_gap.column_dimensions['A'].width = 120
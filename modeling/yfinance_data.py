@@ -1205,7 +1205,7 @@ def fetch_fmp_hk_annual_data(ticker, apikey, target_year=None):
             'cashflow': get_api_url('cash-flow-statement', ticker, 'annual', apikey),
         }
         with ThreadPoolExecutor(max_workers=3) as ex:
-            futures = {k: ex.submit(get_jsonparsed_data, v) for k, v in urls.items()}
+            futures = {k: ex.submit(get_jsonparsed_data, v, cache=True) for k, v in urls.items()}
         inc_list = futures['income'].result()
         bs_list = futures['balance'].result()
         cf_list = futures['cashflow'].result()
@@ -0,0 +1,47 @@
+import subprocess
+
+import pytest
+
+from modeling import ai_analyst
+
+
+class _FinishedProcess:
+    """Stand-in for a Popen object whose CLI has already exited."""
+    stdin = None
+    returncode = 1
+
+    def __init__(self, cmd, **kwargs):
+        self.args = cmd
+        self.kwargs = kwargs
+
+
+@pytest.fixture
+def popen_calls(monkeypatch):
+    calls = []
+
+    def _popen(cmd, **kwargs):
+        proc = _FinishedProcess(cmd, **kwargs)
+        calls.append(proc)
+        return proc
+
+    monkeypatch.setattr(ai_analyst, '_which', lambda cmd: f'/usr/bin/{cmd}')
+    monkeypatch.setattr(ai_analyst.subprocess, 'Popen', _popen)
+    monkeypatch.setattr(ai_analyst, '_read_process_output',
+                        lambda proc, timeout, stdin_data=b'': (b'', b'', None))
+    return calls
+
+
+@pytest.mark.parametrize('engine', ['gemini', 'qwen'])
+def test_prompt_on_argv_engines_get_devnull_stdin(popen_calls, engine):
+    ai_analyst._run_engine(engine, '估值'.encode('utf-8'))
+
+    (proc,) = popen_calls
+    assert proc.kwargs['stdin'] is subprocess.DEVNULL
+    assert proc.args[proc.args.index('-p') + 1] == '估值'
+
+
+def test_claude_reads_prompt_from_stdin_pipe(popen_calls):
+    ai_analyst._run_engine('claude', b'prompt')
+
+    (proc,) = popen_calls
+    assert proc.kwargs['stdin'] is subprocess.PIPE
@@ -9,7 +9,6 @@ Usage:
 
 import json
 import os
-import re
 import sqlite3
 import threading
 import time as _time_mod
@@ -19,6 +18,8 @@ import pandas as pd
 import streamlit as st
 import streamlit.components.v1 as _components
 
+from modeling.ai_analyst import _split_adjusted_price
+
 try:
     import markdown as _md
     _HAS_MD = True
@@ -475,7 +476,7 @@ def _render_ai_reasoning(ai_params_json):
 
 def _render_gap_analysis(gap_text):
     if not gap_text: return None
-    text = re.sub(r'\n?\s*ADJUSTED_PRICE:.*$', '', gap_text).strip()
+    text = _split_adjusted_price(gap_text)[0]
     if _HAS_MD:
         return _md.markdown(text, extensions=['tables'])
     return text
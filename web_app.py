@@ -3,7 +3,6 @@
 
 import io
 import os
-import re
 from datetime import date
 from pathlib import Path
 
@@ -45,6 +44,7 @@ _excel.init_paths(os.path.dirname(os.path.abspath(__file__)))
 
 from modeling.constants import (
     HISTORICAL_DATA_PERIODS_ANNUAL,
+    MIN_GAP_PCT,
     TERMINAL_RISK_PREMIUM,
     TERMINAL_RONIC_PREMIUM,
 )
@@ -2481,6 +2481,11 @@ def _render_progress_toast(placeholder, title, msg, elapsed, done=False):
         f'</div>', unsafe_allow_html=True)
 
 
+# Environment markers set by an enclosing Claude Code session; passing them
+# on makes the CLI refuse to start ("nested session").
+_NESTED_SESSION_ENV_KEYS = frozenset({'CLAUDECODE', 'CLAUDE_CODE', 'CLAUDE_CODE_ENTRYPOINT'})
+
+
 def _run_ai_streaming(prompt, status_label="AI Analysis", live_reasoning=False):
     """Run AI CLI with streaming output, showing real-time progress.
 
@@ -2506,11 +2511,11 @@ def _run_ai_streaming(prompt, status_label="AI Analysis", live_reasoning=False):
 
     start_time = time.time()
 
-    # Preserve full environment to ensure CLI auth/config works,
-    # but remove CLAUDECODE to avoid nested-session detection error
-    current_env = os.environ.copy()
-    current_env.pop('CLAUDECODE', None)
-    current_env.pop('CLAUDE_CODE', None)
+    # Preserve full environment to ensure CLI auth/config works (e.g.
+    # CLAUDE_CODE_OAUTH_TOKEN, CLAUDE_CONFIG_DIR), but remove the nesting
+    # markers that trigger the nested-session error. Built per call so
+    # changes to os.environ in this long-running process are picked up.
+    current_env = {k: v for k, v in os.environ.items() if k not in _NESTED_SESSION_ENV_KEYS}
 
     if live_reasoning:
         return _run_ai_streaming_live(cmd, engine, engine_label, prompt, status_label,
@@ -2891,7 +2896,7 @@ def _parse_cli_output(raw, engine, engine_label, returncode, stderr_content):
     """Parse the CLI output from JSON-wrapped format. Returns the text content."""
     text = raw
     try:
-        data = json.loads(raw)
+        data = _ai_mod._json_loads(raw)
         if engine == 'claude':
             if data.get('is_error') or data.get('type') == 'error':
                 err_msg = data.get('error', '')
@@ -2903,7 +2908,7 @@ def _parse_cli_output(raw, engine, engine_label, returncode, stderr_content):
             text = data.get('result', raw)
             if not _ai_mod._detected_model_name and 'modelUsage' in data:
                 models = data['modelUsage']
-                primary = max(models, key=lambda m: models[m].get('costUSD', 0))
+                primary, _usage = max(models.items(), key=lambda kv: kv[1].get('costUSD', 0))
                 _ai_mod._detected_model_name = _CLAUDE_MODEL_DISPLAY.get(primary, primary)
         elif engine == 'gemini':
             if data.get('is_error'):
@@ -3249,6 +3254,24 @@ def _run_gap_analysis_streaming(ticker, company_profile, results, valuation_para
     else:
         gap_direction = 'DCF above market price, potentially undervalued' if gap_pct > 0 else 'DCF below market price, potentially overvalued'
 
+    # Same threshold as the CLI (_prepare_gap_analysis): small gaps skip the
+    # AI call and the DCF value stands as the adjusted price.
+    if abs(gap_pct) < MIN_GAP_PCT:
+        skip_text = t('gap_small_skip', gap=gap_pct, min=MIN_GAP_PCT)
+        st.info(skip_text)
+        return {
+            'analysis_text': skip_text,
+            'adjusted_price': dcf_price,
+            'adjusted_price_reporting': dcf_price_raw if currency_converted else None,
+            'current_price': current_price,
+            'dcf_price': dcf_price,
+            'dcf_price_raw': dcf_price_raw if currency_converted else None,
+            'gap_pct': gap_pct,
+            'currency': stock_currency,
+            'reported_currency': reported_currency if currency_converted else None,
+            'forex_rate': forex_rate if currency_converted else None,
+        }
+
     currency_note = ""
     if currency_converted:
         if _lang == 'zh':
@@ -3333,13 +3356,7 @@ def _run_gap_analysis_streaming(ticker, company_profile, results, valuation_para
         analysis_text, _ = _run_ai_streaming(prompt, status_label=t('gap_status_label'))
 
     # Parse adjusted price
-    adjusted_price = None
-    price_match = re.search(r'ADJUSTED_PRICE:\s*([\d.,]+)', analysis_text)
-    if price_match:
-        try:
-            adjusted_price = float(price_match.group(1).replace(',', ''))
-        except ValueError:
-            pass
+    _, adjusted_price = _ai_mod._split_adjusted_price(analysis_text)
 
     # Compute adjusted price in reporting currency (reverse forex conversion)
     adjusted_price_reporting = None
@@ -4265,7 +4282,7 @@ if _has_results:
                 if gap.get('adjusted_price_reporting') is not None and gap.get('reported_currency'):
                     _adj_msg += f"  ({gap['adjusted_price_reporting']:,.2f} {gap['reported_currency']})"
                 st.success(_adj_msg)
-            display_text = re.sub(r'\n?\s*ADJUSTED_PRICE:.*$', '', gap.get('analysis_text', '')).strip()
+            display_text = _ai_mod._split_adjusted_price(gap.get('analysis_text', ''))[0]
             # Convert markdown → HTML so we can wrap everything inside a
             # single <div class="ai-card">.  Streamlit wraps each
             # st.markdown() call in its own DOM node, so a separate opening